@@ -3,10 +3,24 @@ import numpy as np
 from torch.utils.data.sampler import Sampler
 
 class BalanceSampler(Sampler):
-    def __init__(self, datasize, batch_size, balance_frac):
+    '''Distribute the largest graphs evenly across batches
+
+    For distributed training, every rank builds the same batches from a
+    shared seed and epoch, and takes every num_replicas-th batch, so each
+    rank keeps whole load-balanced batches and runs the same number of
+    steps.'''
+    def __init__(self, datasize, batch_size, balance_frac,
+                 num_replicas: int = 1, rank: int = 0, seed: int = 0):
         self.datasize = list(datasize)
         self.batch_size = batch_size
         self.balance_frac = balance_frac
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
 
     def __iter__(self):
         # Retrieve dataset size
@@ -14,6 +28,9 @@ class BalanceSampler(Sampler):
         # Calculate number of batches in dataset
         num_batches = int(np.floor(dset_len / self.batch_size))
 
+        # every rank must draw the same random numbers
+        rng = np.random.RandomState(self.seed + self.epoch)
+
         # Assign N as a fraction of the dataset length
         num_outliers = int(np.floor(dset_len * self.balance_frac))
         if num_outliers > dset_len:
@@ -30,8 +47,8 @@ class BalanceSampler(Sampler):
         sample_indices = sample_indices[:dset_len-num_outliers]
 
         # Shuffle indices of n-largest values
-        np.random.shuffle(n_largest_indices)
-        np.random.shuffle(sample_indices)
+        rng.shuffle(n_largest_indices)
+        rng.shuffle(sample_indices)
 
         # Create as many bins as the number of batches
         bins = [ [] for i in range(num_batches) ]
@@ -50,13 +67,21 @@ class BalanceSampler(Sampler):
                 break
             bins[idx].append(sample_index)
 
+        # Assign whole batches to this rank
+        if self.num_replicas > 1:
+            num_batches -= num_batches % self.num_replicas
+            bins = bins[:num_batches][self.rank::self.num_replicas]
+
         # Shuffle each bin and append to indices array
         indices = []
         for bin in bins:
-            np.random.shuffle(bin)
+            rng.shuffle(bin)
             indices += bin
 
         return iter(indices)
 
     def __len__(self):
+        if self.num_replicas > 1:
+            num_batches = len(self.datasize) // self.batch_size
+            return (num_batches // self.num_replicas) * self.batch_size
         return len(self.datasize)
\ No newline at end of file
@@ -1,18 +1,22 @@
 from argparse import ArgumentParser
+import hashlib
 import warnings
 
 import sys
 import h5py
+import numpy as np
 import tqdm
 
 from torch import tensor, cat
 from torch.utils.data import random_split
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 from torch_geometric.transforms import Compose
 from pytorch_lightning import LightningDataModule
 
 from ..data import H5Dataset, BalanceSampler
-from ..util import PositionFeatures, FeatureNormMetric, FeatureNorm
+from ..util import PositionFeatures, FeatureNormMetric, FeatureNorm, MemoryModel
 
 class H5DataModule(LightningDataModule):
     """PyTorch Lightning data module for neutrino graph data."""
@@ -21,7 +25,8 @@ class H5DataModule(LightningDataModule):
                  batch_size: int,
                  shuffle: str = 'random',
                  balance_frac: float = 0.1,
-                 prepare: bool = False):
+                 prepare: bool = False,
+                 cache: str = None):
         super().__init__()
 
         # for this HDF5 dataloader, worker processes slow things down
@@ -80,9 +85,18 @@ class H5DataModule(LightningDataModule):
         transform = Compose((PositionFeatures(self.planes),
                              FeatureNorm(self.planes, norm)))
 
-        self.train_dataset = H5Dataset(self.filename, train_samples, transform)
-        self.val_dataset = H5Dataset(self.filename, val_samples, transform)
-        self.test_dataset = H5Dataset(self.filename, test_samples, transform)
+        # identify the transform for the shared dataset cache
+        key = hashlib.sha1()
+        for t in transform.transforms:
+            key.update(type(t).__name__.encode())
+        for p in self.planes:
+            key.update(p.encode())
+            key.update(norm[p].numpy().tobytes())
+        key = key.hexdigest()
+
+        self.train_dataset = H5Dataset(self.filename, train_samples, transform, cache, key)
+        self.val_dataset = H5Dataset(self.filename, val_samples, transform, cache, key)
+        self.test_dataset = H5Dataset(self.filename, test_samples, transform, cache, key)
 
     @staticmethod
     def generate_samples(data_path: str):
@@ -146,13 +160,74 @@ class H5DataModule(LightningDataModule):
                     del f[key]
                 f[key] = metrics[p].compute()
 
+    def auto_batch_size(self,
+                        model: 'pl.LightningModule',
+                        budget: float,
+                        stage: str = 'train',
+                        max_batch_size: int = 1024,
+                        calibration_sizes: list[int] = [1, 2, 4, 8],
+                        safety: float = 0.9) -> int:
+        '''Select the largest batch size that fits within a memory budget
+
+        A memory model is calibrated on the given model, using batches of the
+        largest training graphs, on whichever device the model is on. The
+        batch size is then chosen so that a batch made up entirely of the
+        largest graphs in the training set is predicted to grow memory by no
+        more than the budget in GB during a step, scaled by a safety factor.
+        Only the calibration graphs are loaded.'''
+        memory = MemoryModel.from_model(model)
+        order = np.argsort(self.train_datasize)[::-1][:max(calibration_sizes)].tolist()
+        calibration = [ Batch.from_data_list([ self.train_dataset[i] for i in order[:n] ])
+                        for n in calibration_sizes if n <= len(order) ]
+        memory.calibrate(model, calibration, [stage])
+
+        # largest batch of copies of the largest graph that fits the budget
+        limit = safety * budget * 1073741824
+        largest = memory.counts(self.train_dataset[order[0]])
+        lo, hi = 0, max_batch_size
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if memory.predict(memory.scale(largest, mid), stage) > limit:
+                hi = mid - 1
+            else:
+                lo = mid
+        batch_size = lo
+        if batch_size == 0:
+            print(f'Largest graph is predicted to exceed the {budget} GB memory budget!')
+            sys.exit()
+        self.batch_size = batch_size
+        return batch_size
+
+    def replicas(self) -> tuple[int, int]:
+        '''Number of distributed processes, and the rank of this one'''
+        trainer = getattr(self, 'trainer', None)
+        if trainer is None:
+            return 1, 0
+        return trainer.world_size, trainer.global_rank
+
+    def setup(self, stage: str) -> None:
+        # batch sizes chosen independently by each process, eg. with
+        # auto_batch_size, can differ, so every rank uses rank zero's
+        num_replicas, _ = self.replicas()
+        if num_replicas > 1:
+            self.batch_size = self.trainer.strategy.broadcast(self.batch_size, src=0)
+
     def train_dataloader(self) -> DataLoader:
+        num_replicas, rank = self.replicas()
         if self.shuffle == 'balance':
             shuffle = False
             sampler = BalanceSampler.BalanceSampler(
                         datasize=self.train_datasize,
                         batch_size=self.batch_size, 
-                        balance_frac=self.balance_frac)
+                        balance_frac=self.balance_frac,
+                        num_replicas=num_replicas,
+                        rank=rank)
+        elif num_replicas > 1:
+            shuffle = False
+            sampler = DistributedSampler(self.train_dataset,
+                                         num_replicas=num_replicas,
+                                         rank=rank, shuffle=True,
+                                         drop_last=True)
         else:
             shuffle = True
             sampler = None
@@ -162,13 +237,22 @@ class H5DataModule(LightningDataModule):
                           sampler=sampler, drop_last=True, 
                           shuffle=shuffle, pin_memory=True)
 
+    def eval_sampler(self, dataset: H5Dataset) -> DistributedSampler:
+        num_replicas, rank = self.replicas()
+        if num_replicas == 1:
+            return None
+        return DistributedSampler(dataset, num_replicas=num_replicas,
+                                  rank=rank, shuffle=False)
+
     def val_dataloader(self) -> DataLoader:
         return DataLoader(self.val_dataset,
-                          batch_size=self.batch_size)
+                          batch_size=self.batch_size,
+                          sampler=self.eval_sampler(self.val_dataset))
 
     def test_dataloader(self) -> DataLoader:
         return DataLoader(self.test_dataset,
-                          batch_size=self.batch_size)
+                          batch_size=self.batch_size,
+                          sampler=self.eval_sampler(self.test_dataset))
 
     @staticmethod
     def add_data_args(parser: ArgumentParser) -> ArgumentParser:
@@ -178,6 +262,10 @@ class H5DataModule(LightningDataModule):
                           help='Location of input data file')
         data.add_argument('--batch-size', type=int, default=64,
                           help='Size of each batch of graphs')
+        data.add_argument('--memory-budget', type=float, default=None,
+                          help='Select the batch size automatically to fit this memory budget in GB')
+        data.add_argument('--cache', type=str, default=None,
+                          help='Node-local directory to cache processed graphs in, eg. /dev/shm. Entries are never evicted, so remove stale nugraph-* directories by hand')
         data.add_argument('--limit_train_batches', type=int, default=None,
                           help='Max number of training batches to be used')
         data.add_argument('--limit_val_batches', type=int, default=None,
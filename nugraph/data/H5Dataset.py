@@ -1,22 +1,76 @@
 from typing import Callable, Optional
 
+import hashlib
+import os
+import stat
+
 import h5py
 from pynuml import io
 
 import torch
 from torch_geometric.data import Dataset
 
+def cache_key(filename: str, transform_key: str = '') -> str:
+    '''Key identifying an input file and the transform applied to it'''
+    stat = os.stat(filename)
+    ident = f'{os.path.realpath(filename)}:{stat.st_dev}:{stat.st_ino}:' \
+            f'{stat.st_size}:{stat.st_mtime_ns}:{transform_key}'
+    return hashlib.sha1(ident.encode()).hexdigest()
+
 class H5Dataset(Dataset):
+    '''Graphs stored in a NuML HDF5 file
+
+    If a cache directory is given, such as /dev/shm, each graph is written
+    there after loading and transforming, the first time any process reads
+    it. Every other process on the node then memory-maps the cached graph
+    rather than reading and decoding it again. Cache entries are keyed by
+    the identity of the input file and by transform_key, which should
+    change whenever the transform does.
+
+    Since other processes load cached graphs with pickle, the cache lives
+    in a subdirectory private to the current user, which must be owned by
+    them and writable by no one else. Cached graphs are never evicted, so
+    stale entries must be removed by hand, eg. rm -r /dev/shm/nugraph-*.'''
     def __init__(self,
                  filename: str,
                  samples: list[str],
-                 transform: Optional[Callable] = None):
-        super().__init__(transform=transform)
+                 transform: Optional[Callable] = None,
+                 cache: Optional[str] = None,
+                 transform_key: str = ''):
+        super().__init__(transform=None if cache else transform)
         self._interface = io.H5Interface(h5py.File(filename))
         self._samples = samples
+        self._cache = None
+        if cache:
+            uid = os.getuid()
+            self._cache = os.path.join(cache, f'nugraph-{uid}-{cache_key(filename, transform_key)}')
+            os.makedirs(self._cache, mode=0o700, exist_ok=True)
+            info = os.lstat(self._cache)
+            if not stat.S_ISDIR(info.st_mode) or info.st_uid != uid \
+                    or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise Exception(f'cache directory {self._cache} must be a directory owned by the current user, and not writable by others')
+            self._cache_transform = transform
 
     def len(self) -> int:
         return len(self._samples)
 
     def get(self, idx: int) -> 'pyg.data.HeteroData':
-        return self._interface.load_heterodata(self._samples[idx])
\ No newline at end of file
+        if self._cache is None:
+            return self._interface.load_heterodata(self._samples[idx])
+
+        name = self._samples[idx].replace('/', '_')
+        path = os.path.join(self._cache, f'{name}.pt')
+        try:
+            return torch.load(path, mmap=True, weights_only=False)
+        except FileNotFoundError:
+            pass
+
+        data = self._interface.load_heterodata(self._samples[idx])
+        if self._cache_transform is not None:
+            data = self._cache_transform(data)
+
+        # write atomically, so concurrent readers never see a partial file
+        tmp = f'{path}.{os.getpid()}.tmp'
+        torch.save(data, tmp)
+        os.replace(tmp, path)
+        return data
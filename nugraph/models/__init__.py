@@ -1,3 +1,4 @@
 # __init__.py
 from .nugraph2 import NuGraph2
 from .nugraph3 import NuGraph3
+from .onnx import export_onnx, OnnxModel
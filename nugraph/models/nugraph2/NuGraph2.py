@@ -1,6 +1,5 @@
 import argparse
 import warnings
-import psutil
 
 import torch
 from torch import Tensor, cat, empty
@@ -8,7 +7,6 @@ from torch.optim import AdamW
 from torch.optim.lr_scheduler import OneCycleLR
 from pytorch_lightning import LightningModule
 from torch_geometric.data import Batch, HeteroData
-from torch_geometric.utils import unbatch
 
 from .encoder import Encoder
 from .plane import PlaneNet
@@ -16,6 +14,7 @@ from .nexus import NexusNet
 from .decoders import SemanticDecoder, FilterDecoder
 
 from ...data import H5DataModule
+from ...util import CheckpointPolicy, ModuleProfiler, flush_figures
 
 class NuGraph2(LightningModule):
     """PyTorch Lightning module for model training.
@@ -32,6 +31,11 @@ class NuGraph2(LightningModule):
                  semantic_head: bool = True,
                  filter_head: bool = True,
                  checkpoint: bool = False,
+                 checkpoint_every: int = 1,
+                 checkpoint_modules: list[str] = ['plane', 'nexus'],
+                 checkpoint_budget: float = None,
+                 decompose: bool = False,
+                 metric_interval: int = 50,
                  lr: float = 0.001):
         super().__init__()
 
@@ -42,8 +46,21 @@ class NuGraph2(LightningModule):
         self.planes = planes
         self.semantic_classes = semantic_classes
         self.num_iters = num_iters
+        self.metric_interval = metric_interval
         self.lr = lr
 
+        self.ckpt_policy = None
+        if checkpoint:
+            num_classes = len(semantic_classes)
+            self.ckpt_policy = CheckpointPolicy(
+                num_classes * in_features,
+                num_classes * planar_features,
+                num_classes * nexus_features,
+                num_iters,
+                every=checkpoint_every,
+                modules=checkpoint_modules,
+                budget=checkpoint_budget * 1073741824 if checkpoint_budget else None)
+
         self.encoder = Encoder(in_features,
                                planar_features,
                                planes,
@@ -53,13 +70,15 @@ class NuGraph2(LightningModule):
                                   planar_features,
                                   len(semantic_classes),
                                   planes,
-                                  checkpoint=checkpoint)
+                                  checkpoint=self.ckpt_policy,
+                                  decompose=decompose)
 
         self.nexus_net = NexusNet(planar_features,
                                   nexus_features,
                                   len(semantic_classes),
                                   planes,
-                                  checkpoint=checkpoint)
+                                  checkpoint=self.ckpt_policy,
+                                  decompose=decompose)
 
         self.decoders = []
 
@@ -80,6 +99,8 @@ class NuGraph2(LightningModule):
         if len(self.decoders) == 0:
             raise Exception('At least one decoder head must be enabled!')
 
+        self.module_profiler = None
+
     def forward(self,
                 x: dict[str, Tensor],
                 edge_index_plane: dict[str, Tensor],
@@ -87,7 +108,15 @@ class NuGraph2(LightningModule):
                 nexus: Tensor,
                 batch: dict[str, Tensor]) -> dict[str, Tensor]:
         m = self.encoder(x)
-        for _ in range(self.num_iters):
+        if self.training and self.ckpt_policy:
+            self.ckpt_policy.configure(
+                { p: x[p].size(0) for p in self.planes },
+                { p: edge_index_plane[p].size(1) for p in self.planes },
+                { p: edge_index_nexus[p].size(1) for p in self.planes },
+                nexus.size(0))
+        for it in range(self.num_iters):
+            if self.ckpt_policy:
+                self.ckpt_policy.iteration = it
             # shortcut connect features
             for i, p in enumerate(self.planes):
                 s = x[p].detach().unsqueeze(1).expand(-1, m[p].size(1), -1)
@@ -99,50 +128,74 @@ class NuGraph2(LightningModule):
             ret.update(decoder(m, batch))
         return ret
 
+    def set_profiler(self, profiler: ModuleProfiler = None) -> None:
+        '''Attach a per-module profiler, or detach the current one if None'''
+        if self.module_profiler is not None:
+            self.module_profiler.detach()
+        self.module_profiler = profiler
+        if profiler is None:
+            return
+        modules = {
+            'encoder': self.encoder,
+            'plane_net': self.plane_net,
+            'nexus_net': self.nexus_net,
+            'nexus_up': self.nexus_net.nexus_up,
+            'nexus_conv': self.nexus_net.nexus_net,
+        }
+        for p, down in self.nexus_net.nexus_down.items():
+            modules[f'nexus_down_{p}'] = down
+        for decoder in self.decoders:
+            modules[f'{decoder.name}_decoder'] = decoder
+        profiler.attach(self, modules, iteration='plane_net')
+
     def step(self, data: HeteroData | Batch):
 
-        # if it's a single data instance, convert to batch manually
+        # if it's a single data instance, all nodes belong to the same graph
         if isinstance(data, Batch):
-            batch = data
+            batch = { p: data[p].batch for p in self.planes }
         else:
-            batch = Batch.from_data_list([data])
+            batch = { p: torch.zeros(data[p].num_nodes, dtype=torch.long,
+                                     device=data[p].x.device)
+                      for p in self.planes }
 
         # unpack tensors to pass into forward function
-        x = self(batch.collect('x'),
-                 { p: batch[p, 'plane', p].edge_index for p in self.planes },
-                 { p: batch[p, 'nexus', 'sp'].edge_index for p in self.planes },
-                 torch.empty(batch['sp'].num_nodes, 0),
-                 { p: batch[p].batch for p in self.planes })
+        x = self(data.collect('x'),
+                 { p: data[p, 'plane', p].edge_index for p in self.planes },
+                 { p: data[p, 'nexus', 'sp'].edge_index for p in self.planes },
+                 torch.empty(data['sp'].num_nodes, 0),
+                 batch)
 
         # append output tensors back onto input data object
-        if isinstance(data, Batch):
-            dlist = [ HeteroData() for i in range(data.num_graphs) ]
-            for attr, planes in x.items():
-                for p, t in planes.items():
-                    if t.size(0) == data[p].num_nodes:
-                        tlist = unbatch(t, data[p].batch)
-                    elif t.size(0) == data.num_graphs:
-                        tlist = unbatch(t, torch.arange(data.num_graphs))
-                    else:
-                        raise Exception(f'don\'t know how to unbatch attribute {attr}')
-                    for it_d, it_t in zip(dlist, tlist):
-                        it_d[p][attr] = it_t
-            tmp = Batch.from_data_list(dlist)
-            data.update(tmp)
-            for attr, planes in x.items():
-                for p in planes:
-                    data._slice_dict[p][attr] = tmp._slice_dict[p][attr]
-                    data._inc_dict[p][attr] = tmp._inc_dict[p][attr]
-
-        else:
-            for key, value in x.items():
-                data.set_value_dict(key, value)
+        self.attach(data, x)
+
+    def attach(self, data: HeteroData | Batch,
+               x: dict[str, dict[str, Tensor]]) -> None:
+        '''Append model output tensors onto input data object
+
+        Outputs are written directly onto the data stores. For batches, slice
+        metadata is taken from the existing node slices, so the batch can
+        still be separated into individual graphs.'''
+        batched = isinstance(data, Batch)
+        if batched:
+            inc = torch.zeros(data.num_graphs, dtype=torch.long)
+            graphs = torch.arange(data.num_graphs + 1)
+        for attr, stores in x.items():
+            for p, t in stores.items():
+                data[p][attr] = t
+                if not batched:
+                    continue
+                if p in self.planes:
+                    slices = data._slice_dict[p]['x']
+                elif t.size(0) == data.num_graphs:
+                    slices = graphs
+                else:
+                    raise Exception(f'don\'t know how to unbatch attribute {attr}')
+                data._slice_dict.setdefault(p, {})[attr] = slices
+                data._inc_dict.setdefault(p, {})[attr] = inc
 
     def on_train_start(self):
         hpmetrics = { 'max_lr': self.hparams.lr }
         self.logger.log_hyperparams(self.hparams, metrics=hpmetrics)
-        self.max_mem_cpu = 0.
-        self.max_mem_gpu = 0.
 
         scalars = {
             'loss': {'loss': [ 'Multiline', [ 'loss/train', 'loss/val' ]]},
@@ -160,12 +213,14 @@ class NuGraph2(LightningModule):
                       batch_idx: int) -> float:
         self.step(batch)
         total_loss = 0.
+        log = (batch_idx + 1) % self.metric_interval == 0
         for decoder in self.decoders:
             loss, metrics = decoder.loss(batch, 'train')
             total_loss += loss
-            self.log_dict(metrics, batch_size=batch.num_graphs)
+            if log:
+                metrics.update(decoder.compute_metrics('train'))
+                self.log_dict(metrics, batch_size=batch.num_graphs)
         self.log('loss/train', total_loss, batch_size=batch.num_graphs, prog_bar=True)
-        self.log_memory(batch, 'train')
         return total_loss
 
     def validation_step(self,
@@ -176,13 +231,16 @@ class NuGraph2(LightningModule):
         for decoder in self.decoders:
             loss, metrics = decoder.loss(batch, 'val', True)
             total_loss += loss
-            self.log_dict(metrics, batch_size=batch.num_graphs)
-        self.log('loss/val', total_loss, batch_size=batch.num_graphs)
+            self.log_dict(metrics, batch_size=batch.num_graphs, sync_dist=True)
+        self.log('loss/val', total_loss, batch_size=batch.num_graphs, sync_dist=True)
 
     def on_validation_epoch_end(self) -> None:
         epoch = self.trainer.current_epoch + 1
+        metrics = {}
         for decoder in self.decoders:
+            metrics.update(decoder.compute_metrics('val'))
             decoder.on_epoch_end(self.logger, 'val', epoch)
+        self.log_dict(metrics)
 
     def test_step(self,
                   batch,
@@ -192,14 +250,22 @@ class NuGraph2(LightningModule):
         for decoder in self.decoders:
             loss, metrics = decoder.loss(batch, 'test', True)
             total_loss += loss
-            self.log_dict(metrics, batch_size=batch.num_graphs)
-        self.log('loss/test', total_loss, batch_size=batch.num_graphs)
-        self.log_memory(batch, 'test')
+            self.log_dict(metrics, batch_size=batch.num_graphs, sync_dist=True)
+        self.log('loss/test', total_loss, batch_size=batch.num_graphs, sync_dist=True)
 
     def on_test_epoch_end(self) -> None:
         epoch = self.trainer.current_epoch + 1
+        metrics = {}
         for decoder in self.decoders:
+            metrics.update(decoder.compute_metrics('test'))
             decoder.on_epoch_end(self.logger, 'test', epoch)
+        self.log_dict(metrics)
+
+    def on_fit_end(self) -> None:
+        flush_figures()
+
+    def on_test_end(self) -> None:
+        flush_figures()
 
     def predict_step(self,
                      batch: Batch,
@@ -216,25 +282,6 @@ class NuGraph2(LightningModule):
                 total_steps=self.trainer.estimated_stepping_batches)
         return [optimizer], {'scheduler': onecycle, 'interval': 'step'}
 
-    def log_memory(self, batch: Batch, stage: str) -> None:
-        # log CPU memory
-        if not hasattr(self, 'max_mem_cpu'):
-            self.max_mem_cpu = 0.
-        cpu_mem = psutil.Process().memory_info().rss / float(1073741824)
-        self.max_mem_cpu = max(self.max_mem_cpu, cpu_mem)
-        self.log(f'memory_cpu/{stage}', self.max_mem_cpu,
-                 batch_size=batch.num_graphs, reduce_fx=torch.max)
-
-        # log GPU memory
-        if not hasattr(self, 'max_mem_gpu'):
-            self.max_mem_gpu = 0.
-        if self.device != torch.device('cpu'):
-            gpu_mem = torch.cuda.memory_reserved(self.device)
-            gpu_mem = float(gpu_mem) / float(1073741824)
-            self.max_mem_gpu = max(self.max_mem_gpu, gpu_mem)
-            self.log(f'memory_gpu/{stage}', self.max_mem_gpu,
-                     batch_size=batch.num_graphs, reduce_fx=torch.max)
-
     @staticmethod
     def add_model_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
         '''Add argparse argpuments for model structure'''
@@ -253,6 +300,17 @@ class NuGraph2(LightningModule):
                            help='Enable background filter head')
         model.add_argument('--no-checkpointing', action='store_true', default=False,
                            help='Disable checkpointing during training')
+        model.add_argument('--checkpoint-every', type=int, default=1,
+                           help='Checkpoint every k-th message-passing iteration')
+        model.add_argument('--checkpoint-modules', type=str, nargs='*',
+                           default=['plane', 'nexus'],
+                           help='Submodules to checkpoint')
+        model.add_argument('--checkpoint-budget', type=float, default=None,
+                           help='Activation memory budget in GB for automatic checkpointing')
+        model.add_argument('--decompose-edges', action='store_true', default=False,
+                           help='Use memory-efficient decomposed edge networks')
+        model.add_argument('--metric-interval', type=int, default=50,
+                           help='Number of training steps between metric logging')
         model.add_argument('--epochs', type=int, default=80,
                            help='Maximum number of epochs to train for')
         model.add_argument('--learning-rate', type=float, default=0.001,
@@ -271,4 +329,9 @@ class NuGraph2(LightningModule):
             semantic_head=args.semantic,
             filter_head=args.filter,
             checkpoint=not args.no_checkpointing,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_modules=args.checkpoint_modules,
+            checkpoint_budget=args.checkpoint_budget,
+            decompose=args.decompose_edges,
+            metric_interval=args.metric_interval,
             lr=args.learning_rate)
@@ -1,19 +1,19 @@
-from typing import Any, Callable
+from typing import Callable
 
 from abc import ABC
 
-from torch import Tensor, tensor, cat
+from torch import Tensor, tensor, cat, autocast, no_grad
 import torch.nn as nn
 from torch_geometric.nn.aggr import SoftmaxAggregation, LSTMAggregation
 
 import torchmetrics as tm
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sn
 import math
 
 from .linear import ClassLinear
-from ...util import RecallLoss, LogCoshLoss
+from ...util import RecallLoss, LogCoshLoss, log_figure
 
 class DecoderBase(nn.Module, ABC):
     '''Base class for all NuGraph decoders'''
@@ -32,40 +32,66 @@ class DecoderBase(nn.Module, ABC):
         self.weight = weight
         self.temp = nn.Parameter(tensor(temperature))
         self.confusion = nn.ModuleDict()
+        self.stage_metrics = nn.ModuleDict()
 
     def arrange(self, batch) -> tuple[Tensor, Tensor]:
         raise NotImplementedError
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        raise NotImplementedError
+    def add_metrics(self, metrics: dict[str, tm.Metric]) -> None:
+        '''Register metrics, accumulated separately for each stage'''
+        collection = tm.MetricCollection(metrics)
+        for stage in ('train', 'val', 'test'):
+            # keyed by suffix, since 'train' clashes with nn.Module.train
+            self.stage_metrics[f'{stage}_metrics'] = collection.clone(postfix=f'/{stage}')
+
+    def compute_metrics(self, stage: str) -> dict[str, Tensor]:
+        '''Reduce and reset the metrics accumulated for a stage'''
+        key = f'{stage}_metrics'
+        if key not in self.stage_metrics:
+            return {}
+        metrics = self.stage_metrics[key].compute()
+        self.stage_metrics[key].reset()
+        return metrics
 
     def loss(self,
              batch,
              stage: str,
              confusion: bool = False):
         x, y = self.arrange(batch)
-        metrics = self.metrics(x, y, stage)
-        w = self.weight * (-1 * self.temp).exp()
-        loss = w * self.loss_func(x, y) + self.temp
-        metrics[f'loss_{self.name}/{stage}'] = loss
+        # losses and metrics are always evaluated in full precision
+        with autocast(x.device.type, enabled=False):
+            x = x.float()
+            w = self.weight * (-1 * self.temp).exp()
+            loss = w * self.loss_func(x, y) + self.temp
+
+        # metrics are accumulated on device, and only reduced on request
+        with no_grad():
+            x = x.detach()
+            self.stage_metrics[f'{stage}_metrics'].update(x, y)
+            if confusion:
+                for cm in self.confusion.values():
+                    cm.update(x, y)
+        metrics = { f'loss_{self.name}/{stage}': loss.detach() }
         if stage == 'train':
-            metrics[f'temperature/{self.name}'] = self.temp
-        for cm in self.confusion.values():
-            cm.update(x, y)
+            metrics[f'temperature/{self.name}'] = self.temp.detach()
         return loss, metrics
 
-    def draw_confusion_matrix(self, cm: tm.ConfusionMatrix) -> plt.Figure:
+    def finalize(self, batch) -> None:
+        return
+
+    def draw_confusion_matrix(self, confusion: Tensor) -> Figure:
         '''Produce confusion matrix at end of epoch'''
-        confusion = cm.compute().cpu()
-        fig = plt.figure(figsize=[8,6])
+        fig = Figure(figsize=[8,6])
+        ax = fig.add_subplot()
         sn.heatmap(confusion,
                    xticklabels=self.classes,
                    yticklabels=self.classes,
                    vmin=0, vmax=1,
-                   annot=True)
-        plt.ylim(0, len(self.classes))
-        plt.xlabel('Assigned label')
-        plt.ylabel('True label')
+                   annot=True,
+                   ax=ax)
+        ax.set_ylim(0, len(self.classes))
+        ax.set_xlabel('Assigned label')
+        ax.set_ylabel('True label')
         return fig
 
     def on_epoch_end(self,
@@ -73,11 +99,13 @@ class DecoderBase(nn.Module, ABC):
                      stage: str,
                      epoch: int) -> None:
         if not logger: return
+        # matrices are reduced here, and rendered off the training thread
         for name, cm in self.confusion.items():
-            logger.experiment.add_figure(
-                f'{name}/{stage}',
-                self.draw_confusion_matrix(cm),
-                global_step=epoch)
+            log_figure(logger,
+                       f'{name}/{stage}',
+                       self.draw_confusion_matrix,
+                       cm.compute().cpu(),
+                       global_step=epoch)
             cm.reset()
 
 class SemanticDecoder(DecoderBase):
@@ -103,8 +131,10 @@ class SemanticDecoder(DecoderBase):
             'ignore_index': -1
         }
 
-        self.recall = tm.Recall(**metric_args)
-        self.precision = tm.Precision(**metric_args)
+        self.add_metrics({
+            'recall_semantic': tm.Recall(**metric_args),
+            'precision_semantic': tm.Precision(**metric_args),
+        })
         self.confusion['recall_semantic_matrix'] = tm.ConfusionMatrix(
             normalize='true', **metric_args)
         self.confusion['precision_semantic_matrix'] = tm.ConfusionMatrix(
@@ -123,12 +153,6 @@ class SemanticDecoder(DecoderBase):
         y = cat([batch[p].y_semantic for p in self.planes], dim=0)
         return x, y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        return {
-            f'recall_semantic/{stage}': self.recall(x, y),
-            f'precision_semantic/{stage}': self.precision(x, y)
-        }
-
 class FilterDecoder(DecoderBase):
     """NuGraph filter decoder module.
 
@@ -150,8 +174,10 @@ class FilterDecoder(DecoderBase):
             'task': 'binary'
         }
 
-        self.recall = tm.Recall(**metric_args)
-        self.precision = tm.Precision(**metric_args)
+        self.add_metrics({
+            'recall_filter': tm.Recall(**metric_args),
+            'precision_filter': tm.Precision(**metric_args),
+        })
         self.confusion['recall_filter_matrix'] = tm.ConfusionMatrix(
             normalize='true', **metric_args)
         self.confusion['precision_filter_matrix'] = tm.ConfusionMatrix(
@@ -172,9 +198,3 @@ class FilterDecoder(DecoderBase):
         x = cat([batch[p].x_filter for p in self.planes], dim=0)
         y = cat([(batch[p].y_semantic!=-1).float() for p in self.planes], dim=0)
         return x, y
-
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        return {
-            f'recall_filter/{stage}': self.recall(x, y),
-            f'precision_filter/{stage}': self.precision(x, y)
-        }
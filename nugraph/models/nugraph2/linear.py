@@ -1,5 +1,6 @@
 from torch import Tensor, tensor_split, cat
 import torch.nn as nn
+import torch.nn.functional as F
 
 class ClassLinear(nn.Module):
     '''Linear convolution module grouped by class'''
@@ -17,4 +18,11 @@ class ClassLinear(nn.Module):
 
     def forward(self, X: Tensor) -> Tensor:
         x = tensor_split(X, self.num_classes, dim=1)
-        return cat([ net(x[i]) for i, net in enumerate(self.net) ], dim=1)
\ No newline at end of file
+        return cat([ net(x[i]) for i, net in enumerate(self.net) ], dim=1)
+
+    def partial(self, X: Tensor, start: int, end: int, bias: bool = True) -> Tensor:
+        '''Apply input feature columns [start, end) of each class's weights'''
+        x = tensor_split(X, self.num_classes, dim=1)
+        return cat([ F.linear(x[i], net.weight[:, start:end],
+                              net.bias if bias else None)
+                     for i, net in enumerate(self.net) ], dim=1)
@@ -7,6 +7,7 @@ from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import MessagePassing, SimpleConv
 
 from .linear import ClassLinear
+from ...util import CheckpointPolicy
 
 class NexusDown(MessagePassing):
     def __init__(self,
@@ -41,6 +42,22 @@ class NexusDown(MessagePassing):
     def update(self, aggr_out: Tensor, x: Tensor) -> Tensor:
         return self.node_net(cat((x, aggr_out), dim=-1))
 
+class DecomposedNexusDown(NexusDown):
+    '''Memory-efficient equivalent of NexusDown
+
+    Planar and nexus nodes are each projected once through their half of the
+    first edge network layer, and the per-class projections are summed per
+    edge instead of concatenating features for every edge.'''
+    def forward(self, x: Tensor, edge_index: Tensor, n: Tensor) -> Tensor:
+        lin = self.edge_net[0]
+        f = x.size(-1)
+        e_x = lin.partial(x.detach(), 0, f)
+        e_n = lin.partial(n.detach(), f, f+n.size(-1), bias=False)
+        return self.propagate(edge_index=edge_index, x=x, n=n, e_x=e_x, e_n=e_n)
+
+    def message(self, n_j: Tensor, e_x_i: Tensor, e_n_j: Tensor) -> Tensor:
+        return self.edge_net[1](e_x_i + e_n_j) * n_j
+
 class NexusNet(nn.Module):
     '''Module to project to nexus space and mix detector planes'''
     def __init__(self,
@@ -49,7 +66,8 @@ class NexusNet(nn.Module):
                  num_classes: int,
                  planes: list[str],
                  aggr: str = 'mean',
-                 checkpoint: bool = True):
+                 checkpoint: CheckpointPolicy = None,
+                 decompose: bool = False):
         super().__init__()
 
         self.checkpoint = checkpoint
@@ -66,15 +84,16 @@ class NexusNet(nn.Module):
                         num_classes),
             nn.Tanh())
 
+        down = DecomposedNexusDown if decompose else NexusDown
         self.nexus_down = nn.ModuleDict()
         for p in planes:
-            self.nexus_down[p] = NexusDown(planar_features,
-                                           nexus_features,
-                                           num_classes,
-                                           aggr)
+            self.nexus_down[p] = down(planar_features,
+                                      nexus_features,
+                                      num_classes,
+                                      aggr)
 
     def ckpt(self, fn: Callable, *args) -> Any:
-        if self.checkpoint and self.training:
+        if self.training and self.checkpoint and self.checkpoint('nexus'):
             return checkpoint(fn, *args)
         else:
             return fn(*args)
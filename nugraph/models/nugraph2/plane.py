@@ -7,6 +7,7 @@ from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import MessagePassing
 
 from .linear import ClassLinear
+from ...util import CheckpointPolicy
 
 class MessagePassing2D(MessagePassing):
 
@@ -44,6 +45,28 @@ class MessagePassing2D(MessagePassing):
     def update(self, aggr_out: Tensor, x: Tensor):
         return self.node_net(cat((x, aggr_out), dim=-1))
 
+class DecomposedMessagePassing2D(MessagePassing2D):
+    '''Memory-efficient equivalent of MessagePassing2D
+
+    The first edge network layer is linear, so rather than concatenating
+    features for every edge, each node is projected once through the two
+    halves of its weight matrix and the per-class projections are summed per
+    edge. Parameters are identical to MessagePassing2D.'''
+
+    propagate_type = { 'x': Tensor, 'e_dst': Tensor, 'e_src': Tensor }
+
+    def forward(self, x: Tensor, edge_index: Tensor):
+        lin = self.edge_net[0]
+        f = x.size(-1)
+        h = x.detach()
+        return self.propagate(edge_index, x=x,
+                              e_dst=lin.partial(h, 0, f),
+                              e_src=lin.partial(h, f, 2*f, bias=False),
+                              size=None)
+
+    def message(self, x_j: Tensor, e_dst_i: Tensor, e_src_j: Tensor):
+        return self.edge_net[1](e_dst_i + e_src_j) * x_j
+
 class PlaneNet(nn.Module):
     '''Module to convolve within each detector plane'''
     def __init__(self,
@@ -52,20 +75,22 @@ class PlaneNet(nn.Module):
                  num_classes: int,
                  planes: list[str],
                  aggr: str = 'add',
-                 checkpoint: bool = True):
+                 checkpoint: CheckpointPolicy = None,
+                 decompose: bool = False):
         super().__init__()
 
         self.checkpoint = checkpoint
 
+        mp = DecomposedMessagePassing2D if decompose else MessagePassing2D
         self.net = nn.ModuleDict()
         for p in planes:
-            self.net[p] = MessagePassing2D(in_features,
-                                           planar_features,
-                                           num_classes,
-                                           aggr)
+            self.net[p] = mp(in_features,
+                             planar_features,
+                             num_classes,
+                             aggr)
 
     def ckpt(self, fn: Callable, *args) -> Any:
-        if self.checkpoint and self.training:
+        if self.training and self.checkpoint and self.checkpoint('plane'):
             return checkpoint(fn, *args)
         else:
             return fn(*args)
@@ -1,6 +1,5 @@
 import argparse
 import warnings
-import psutil
 
 import torch
 from torch import Tensor, cat, empty
@@ -8,14 +7,21 @@ from torch.optim import AdamW
 from torch.optim.lr_scheduler import OneCycleLR
 from pytorch_lightning import LightningModule
 from torch_geometric.data import Batch, HeteroData
-from torch_geometric.utils import unbatch
 
 from .encoder import Encoder
 from .plane import PlaneNet
 from .nexus import NexusNet
-from .decoders import SemanticDecoder, FilterDecoder, EventDecoder, VertexDecoder
+from .decoders import SemanticDecoder, FilterDecoder, EventDecoder, VertexDecoder, InstanceDecoder
 
 from ...data import H5DataModule
+from ...util import CheckpointPolicy, ModuleProfiler, flush_figures
+
+def mask_edges(edge_index: Tensor, src_mask: Tensor, dst_mask: Tensor) -> Tensor:
+    '''Restrict edges to masked source and target nodes, and reindex them'''
+    keep = src_mask[edge_index[0]] & dst_mask[edge_index[1]]
+    src = src_mask.cumsum(0) - 1
+    dst = dst_mask.cumsum(0) - 1
+    return torch.stack((src[edge_index[0, keep]], dst[edge_index[1, keep]]))
 
 class NuGraph3(LightningModule):
     """PyTorch Lightning module for model training.
@@ -29,6 +35,7 @@ class NuGraph3(LightningModule):
                  vertex_aggr: str = 'lstm',
                  vertex_lstm_features: int = 64,
                  vertex_mlp_features: list[int] = [ 64 ],
+                 instance_features: int = 3,
                  planes: list[str] = ['u','v','y'],
                  semantic_classes: list[str] = ['MIP','HIP','shower','michel','diffuse'],
                  event_classes: list[str] = ['numu','nue','nc'],
@@ -37,7 +44,14 @@ class NuGraph3(LightningModule):
                  semantic_head: bool = True,
                  filter_head: bool = True,
                  vertex_head: bool = False,
+                 instance_head: bool = False,
                  checkpoint: bool = False,
+                 checkpoint_every: int = 1,
+                 checkpoint_modules: list[str] = ['plane', 'nexus'],
+                 checkpoint_budget: float = None,
+                 decompose: bool = False,
+                 sparse_nexus: bool = False,
+                 metric_interval: int = 50,
                  lr: float = 0.001):
         super().__init__()
 
@@ -49,8 +63,21 @@ class NuGraph3(LightningModule):
         self.semantic_classes = semantic_classes
         self.event_classes = event_classes
         self.num_iters = num_iters
+        self.sparse_nexus = sparse_nexus
+        self.metric_interval = metric_interval
         self.lr = lr
 
+        self.ckpt_policy = None
+        if checkpoint:
+            self.ckpt_policy = CheckpointPolicy(
+                in_features,
+                planar_features,
+                nexus_features,
+                num_iters,
+                every=checkpoint_every,
+                modules=checkpoint_modules,
+                budget=checkpoint_budget * 1073741824 if checkpoint_budget else None)
+
         self.encoder = Encoder(in_features,
                                planar_features,
                                planes,
@@ -59,12 +86,14 @@ class NuGraph3(LightningModule):
         self.plane_net = PlaneNet(in_features,
                                   planar_features,
                                   planes,
-                                  checkpoint=checkpoint)
+                                  checkpoint=self.ckpt_policy,
+                                  decompose=decompose)
 
         self.nexus_net = NexusNet(planar_features,
                                   nexus_features,
                                   planes,
-                                  checkpoint=checkpoint)
+                                  checkpoint=self.ckpt_policy,
+                                  decompose=decompose)
 
         self.decoders = []
 
@@ -99,9 +128,19 @@ class NuGraph3(LightningModule):
                 semantic_classes)
             self.decoders.append(self.vertex_decoder)
 
+        if instance_head:
+            self.instance_decoder = InstanceDecoder(
+                planar_features,
+                planes,
+                instance_features)
+            self.decoders.append(self.instance_decoder)
+
         if len(self.decoders) == 0:
             raise Exception('At least one decoder head must be enabled!')
 
+        self.early_exit = None
+        self.module_profiler = None
+
     def forward(self,
                 x: dict[str, Tensor],
                 edge_index_plane: dict[str, Tensor],
@@ -109,73 +148,203 @@ class NuGraph3(LightningModule):
                 nexus: Tensor,
                 batch: dict[str, Tensor]) -> dict[str, Tensor]:
         m = self.encoder(x)
-        for _ in range(self.num_iters):
+        if self.training and self.ckpt_policy:
+            self.ckpt_policy.configure(
+                { p: x[p].size(0) for p in self.planes },
+                { p: edge_index_plane[p].size(1) for p in self.planes },
+                { p: edge_index_nexus[p].size(1) for p in self.planes },
+                nexus.size(0))
+        projection = None
+        if self.sparse_nexus:
+            projection = self.nexus_net.projection(edge_index_nexus, x, nexus)
+        for it in range(self.num_iters):
+            if self.ckpt_policy:
+                self.ckpt_policy.iteration = it
             # shortcut connect features
             for i, p in enumerate(self.planes):
                 m[p] = torch.cat((m[p], x[p]), dim=-1)
             self.plane_net(m, edge_index_plane)
-            self.nexus_net(m, edge_index_nexus, nexus)
+            self.nexus_net(m, edge_index_nexus, nexus, projection)
         ret = {}
         for decoder in self.decoders:
             ret.update(decoder(m, batch))
         return ret
 
+    @torch.no_grad()
+    def forward_early_exit(self,
+                           data: Batch,
+                           tol: float,
+                           per_graph: bool = True,
+                           min_iters: int = 1) -> tuple[dict[str, Tensor], Tensor]:
+        '''Run inference, stopping message passing once predictions converge
+
+        Semantic and filter predictions are evaluated after every iteration.
+        Once they change by less than tol for a graph, that graph is removed
+        from further message passing, or if per_graph is false, iterations
+        stop once every graph in the batch has converged. Returns the model
+        outputs and the number of iterations run for each graph.'''
+        monitors = [ d for d in self.decoders
+                     if isinstance(d, (SemanticDecoder, FilterDecoder)) ]
+        if not monitors:
+            raise Exception('Early exit requires a semantic or filter decoder!')
+
+        x = data.collect('x')
+        edge_index_plane = { p: data[p, 'plane', p].edge_index for p in self.planes }
+        edge_index_nexus = { p: data[p, 'nexus', 'sp'].edge_index for p in self.planes }
+        batch = { p: data[p].batch for p in self.planes }
+        sp_batch = data['sp'].batch
+        nexus = torch.empty(data['sp'].num_nodes, 0, device=sp_batch.device)
+
+        active = torch.ones(data.num_graphs, dtype=torch.bool, device=sp_batch.device)
+        iters = torch.zeros(data.num_graphs, dtype=torch.long, device=sp_batch.device)
+        prev = {}
+
+        m = self.encoder(x)
+        for it in range(self.num_iters):
+
+            # restrict message passing to unconverged graphs
+            node_mask = { p: active[batch[p]] for p in self.planes }
+            sp_mask = active[sp_batch]
+            idx = { p: node_mask[p].nonzero().squeeze(1) for p in self.planes }
+            sub = { p: torch.cat((m[p][idx[p]], x[p][idx[p]]), dim=-1) for p in self.planes }
+            self.plane_net(sub, { p: mask_edges(edge_index_plane[p], node_mask[p], node_mask[p])
+                                  for p in self.planes })
+            self.nexus_net(sub, { p: mask_edges(edge_index_nexus[p], node_mask[p], sp_mask)
+                                  for p in self.planes }, nexus[sp_mask])
+            for p in self.planes:
+                m[p] = m[p].index_copy(0, idx[p], sub[p])
+            iters[active] += 1
+
+            # largest change in node predictions for each graph
+            delta = torch.zeros(data.num_graphs, device=sp_batch.device)
+            for decoder in monitors:
+                for attr, planes in decoder(sub, batch).items():
+                    for p, t in planes.items():
+                        if attr == 'x_semantic':
+                            t = t.softmax(dim=1)
+                        if (attr, p) not in prev:
+                            prev[attr, p] = t.new_zeros((x[p].size(0),) + t.shape[1:])
+                        d = (t - prev[attr, p][idx[p]]).abs()
+                        if d.dim() > 1:
+                            d = d.amax(dim=1)
+                        delta = delta.scatter_reduce(0, batch[p][idx[p]], d, 'amax')
+                        prev[attr, p] = prev[attr, p].index_copy(0, idx[p], t)
+
+            if it > 0 and it + 1 >= min_iters:
+                converged = delta < tol
+                if per_graph:
+                    active &= ~converged
+                elif converged[active].all():
+                    break
+                if not active.any():
+                    break
+
+        ret = {}
+        for decoder in self.decoders:
+            ret.update(decoder(m, batch))
+        return ret, iters
+
+    def set_early_exit(self,
+                       tol: float = None,
+                       per_graph: bool = True,
+                       min_iters: int = 1) -> None:
+        '''Enable early exit over message-passing iterations at prediction,
+        or disable it if tol is None'''
+        self.early_exit = None
+        if tol is not None:
+            self.early_exit = { 'tol': tol, 'per_graph': per_graph, 'min_iters': min_iters }
+
+    def set_profiler(self, profiler: ModuleProfiler = None) -> None:
+        '''Attach a per-module profiler, or detach the current one if None'''
+        if self.module_profiler is not None:
+            self.module_profiler.detach()
+        self.module_profiler = profiler
+        if profiler is None:
+            return
+        modules = {
+            'encoder': self.encoder,
+            'plane_net': self.plane_net,
+            'nexus_net': self.nexus_net,
+            'nexus_conv': self.nexus_net.nexus_net,
+        }
+        if self.sparse_nexus:
+            # the sparse path aggregates all planes at once, and then
+            # updates each plane's nodes without calling its down module
+            modules['nexus_up'] = self.nexus_net.sparse_up
+            modules['nexus_down'] = self.nexus_net.sparse_down
+            for p, down in self.nexus_net.nexus_down.items():
+                modules[f'nexus_update_{p}'] = down.node_net
+        else:
+            modules['nexus_up'] = self.nexus_net.nexus_up
+            for p, down in self.nexus_net.nexus_down.items():
+                modules[f'nexus_down_{p}'] = down
+        for decoder in self.decoders:
+            modules[f'{decoder.name}_decoder'] = decoder
+        profiler.attach(self, modules, iteration='plane_net')
+
     def step(self, data: HeteroData | Batch,
              stage: str = None,
              confusion: bool = False):
 
-        # if it's a single data instance, convert to batch manually
+        # if it's a single data instance, all nodes belong to the same graph
         if isinstance(data, Batch):
-            batch = data
+            batch = { p: data[p].batch for p in self.planes }
         else:
-            batch = Batch.from_data_list([data])
+            batch = { p: torch.zeros(data[p].num_nodes, dtype=torch.long,
+                                     device=data[p].x.device)
+                      for p in self.planes }
 
         # unpack tensors to pass into forward function
-        x = self(batch.collect('x'),
-                 { p: batch[p, 'plane', p].edge_index for p in self.planes },
-                 { p: batch[p, 'nexus', 'sp'].edge_index for p in self.planes },
-                 torch.empty(batch['sp'].num_nodes, 0),
-                 { p: batch[p].batch for p in self.planes })
+        x = self(data.collect('x'),
+                 { p: data[p, 'plane', p].edge_index for p in self.planes },
+                 { p: data[p, 'nexus', 'sp'].edge_index for p in self.planes },
+                 torch.empty(data['sp'].num_nodes, 0),
+                 batch)
 
         # append output tensors back onto input data object
-        if isinstance(data, Batch):
-            dlist = [ HeteroData() for i in range(data.num_graphs) ]
-            for attr, planes in x.items():
-                for p, t in planes.items():
-                    if t.size(0) == data[p].num_nodes:
-                        tlist = unbatch(t, data[p].batch)
-                    elif t.size(0) == data.num_graphs:
-                        tlist = unbatch(t, torch.arange(data.num_graphs))
-                    else:
-                        raise Exception(f'don\'t know how to unbatch attribute {attr}')
-                    for it_d, it_t in zip(dlist, tlist):
-                        it_d[p][attr] = it_t
-            tmp = Batch.from_data_list(dlist)
-            data.update(tmp)
-            for attr, planes in x.items():
-                for p in planes:
-                    data._slice_dict[p][attr] = tmp._slice_dict[p][attr]
-                    data._inc_dict[p][attr] = tmp._inc_dict[p][attr]
-
-        else:
-            for key, value in x.items():
-                data.set_value_dict(key, value)
+        self.attach(data, x)
 
+        # instance clustering is costly, and only needed for predictions
+        predict = stage is None and not self.training
         total_loss = 0.
         total_metrics = {}
         for decoder in self.decoders:
             loss, metrics = decoder.loss(data, stage, confusion)
             total_loss += loss
             total_metrics.update(metrics)
-            decoder.finalize(data)
+            if predict or not isinstance(decoder, InstanceDecoder):
+                decoder.finalize(data)
 
         return total_loss, total_metrics
 
+    def attach(self, data: HeteroData | Batch,
+               x: dict[str, dict[str, Tensor]]) -> None:
+        '''Append model output tensors onto input data object
+
+        Outputs are written directly onto the data stores. For batches, slice
+        metadata is taken from the existing node slices, so the batch can
+        still be separated into individual graphs.'''
+        batched = isinstance(data, Batch)
+        if batched:
+            inc = torch.zeros(data.num_graphs, dtype=torch.long)
+            graphs = torch.arange(data.num_graphs + 1)
+        for attr, stores in x.items():
+            for p, t in stores.items():
+                data[p][attr] = t
+                if not batched:
+                    continue
+                if p in self.planes:
+                    slices = data._slice_dict[p]['x']
+                elif t.size(0) == data.num_graphs:
+                    slices = graphs
+                else:
+                    raise Exception(f'don\'t know how to unbatch attribute {attr}')
+                data._slice_dict.setdefault(p, {})[attr] = slices
+                data._inc_dict.setdefault(p, {})[attr] = inc
+
     def on_train_start(self):
         hpmetrics = { 'max_lr': self.hparams.lr }
         self.logger.log_hyperparams(self.hparams, metrics=hpmetrics)
-        self.max_mem_cpu = 0.
-        self.max_mem_gpu = 0.
 
         scalars = {
             'loss': {'loss': [ 'Multiline', [ 'loss/train', 'loss/val' ]]},
@@ -193,39 +362,58 @@ class NuGraph3(LightningModule):
                       batch_idx: int) -> float:
         loss, metrics = self.step(batch, 'train')
         self.log('loss/train', loss, batch_size=batch.num_graphs, prog_bar=True)
-        self.log_dict(metrics, batch_size=batch.num_graphs)
-        self.log_memory(batch, 'train')
+        if (batch_idx + 1) % self.metric_interval == 0:
+            for decoder in self.decoders:
+                metrics.update(decoder.compute_metrics('train'))
+            self.log_dict(metrics, batch_size=batch.num_graphs)
         return loss
 
     def validation_step(self,
                         batch,
                         batch_idx: int) -> None:
         loss, metrics = self.step(batch, 'val', True)
-        self.log('loss/val', loss, batch_size=batch.num_graphs)
-        self.log_dict(metrics, batch_size=batch.num_graphs)
+        self.log('loss/val', loss, batch_size=batch.num_graphs, sync_dist=True)
+        self.log_dict(metrics, batch_size=batch.num_graphs, sync_dist=True)
 
     def on_validation_epoch_end(self) -> None:
         epoch = self.trainer.current_epoch + 1
+        metrics = {}
         for decoder in self.decoders:
+            metrics.update(decoder.compute_metrics('val'))
             decoder.on_epoch_end(self.logger, 'val', epoch)
+        self.log_dict(metrics)
 
     def test_step(self,
                   batch,
                   batch_idx: int = 0) -> None:
         loss, metrics = self.step(batch, 'test', True)
-        self.log('loss/test', loss, batch_size=batch.num_graphs)
-        self.log_dict(metrics, batch_size=batch.num_graphs)
-        self.log_memory(batch, 'test')
+        self.log('loss/test', loss, batch_size=batch.num_graphs, sync_dist=True)
+        self.log_dict(metrics, batch_size=batch.num_graphs, sync_dist=True)
 
     def on_test_epoch_end(self) -> None:
         epoch = self.trainer.current_epoch + 1
+        metrics = {}
         for decoder in self.decoders:
+            metrics.update(decoder.compute_metrics('test'))
             decoder.on_epoch_end(self.logger, 'test', epoch)
+        self.log_dict(metrics)
+
+    def on_fit_end(self) -> None:
+        flush_figures()
+
+    def on_test_end(self) -> None:
+        flush_figures()
 
     def predict_step(self,
                      batch: Batch,
                      batch_idx: int = 0) -> Batch:
-        self.step(batch)
+        if self.early_exit:
+            x, _ = self.forward_early_exit(batch, **self.early_exit)
+            self.attach(batch, x)
+            for decoder in self.decoders:
+                decoder.finalize(batch)
+        else:
+            self.step(batch)
         return batch
 
     def configure_optimizers(self) -> tuple:
@@ -237,25 +425,6 @@ class NuGraph3(LightningModule):
                 total_steps=self.trainer.estimated_stepping_batches)
         return [optimizer], {'scheduler': onecycle, 'interval': 'step'}
 
-    def log_memory(self, batch: Batch, stage: str) -> None:
-        # log CPU memory
-        if not hasattr(self, 'max_mem_cpu'):
-            self.max_mem_cpu = 0.
-        cpu_mem = psutil.Process().memory_info().rss / float(1073741824)
-        self.max_mem_cpu = max(self.max_mem_cpu, cpu_mem)
-        self.log(f'memory_cpu/{stage}', self.max_mem_cpu,
-                 batch_size=batch.num_graphs, reduce_fx=torch.max)
-
-        # log GPU memory
-        if not hasattr(self, 'max_mem_gpu'):
-            self.max_mem_gpu = 0.
-        if self.device != torch.device('cpu'):
-            gpu_mem = torch.cuda.memory_reserved(self.device)
-            gpu_mem = float(gpu_mem) / float(1073741824)
-            self.max_mem_gpu = max(self.max_mem_gpu, gpu_mem)
-            self.log(f'memory_gpu/{stage}', self.max_mem_gpu,
-                     batch_size=batch.num_graphs, reduce_fx=torch.max)
-
     @staticmethod
     def add_model_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
         '''Add argparse argpuments for model structure'''
@@ -269,11 +438,13 @@ class NuGraph3(LightningModule):
         model.add_argument('--nexus-feats', type=int, default=32,
                            help='Hidden dimensionality of nexus convolutions')
         model.add_argument('--vertex-aggr', type=str, default='lstm',
-                           help='Aggregation function for vertex decoder')
+                           help='Aggregation function for vertex decoder, eg. lstm or attention')
         model.add_argument('--vertex-lstm-feats', type=int, default=32,
-                           help='Hidden dimensionality of vertex LSTM aggregation')
+                           help='Hidden dimensionality of vertex LSTM or attention aggregation')
         model.add_argument('--vertex-mlp-feats', type=int, nargs='*', default=[32],
                            help='Hidden dimensionality of vertex decoder')
+        model.add_argument('--instance-feats', type=int, default=3,
+                           help='Dimensionality of instance clustering space')
         model.add_argument('--event', action='store_true', default=False,
                            help='Enable event classification head')
         model.add_argument('--semantic', action='store_true', default=False,
@@ -282,8 +453,23 @@ class NuGraph3(LightningModule):
                            help='Enable background filter head')
         model.add_argument('--vertex', action='store_true', default=False,
                            help='Enable vertex regression head')
+        model.add_argument('--instance', action='store_true', default=False,
+                           help='Enable instance segmentation head')
         model.add_argument('--no-checkpointing', action='store_true', default=False,
                            help='Disable checkpointing during training')
+        model.add_argument('--checkpoint-every', type=int, default=1,
+                           help='Checkpoint every k-th message-passing iteration')
+        model.add_argument('--checkpoint-modules', type=str, nargs='*',
+                           default=['plane', 'nexus'],
+                           help='Submodules to checkpoint')
+        model.add_argument('--checkpoint-budget', type=float, default=None,
+                           help='Activation memory budget in GB for automatic checkpointing')
+        model.add_argument('--decompose-edges', action='store_true', default=False,
+                           help='Use memory-efficient decomposed edge networks')
+        model.add_argument('--sparse-nexus', action='store_true', default=False,
+                           help='Project to and from nexus space with precomputed sparse matrices')
+        model.add_argument('--metric-interval', type=int, default=50,
+                           help='Number of training steps between metric logging')
         model.add_argument('--epochs', type=int, default=80,
                            help='Maximum number of epochs to train for')
         model.add_argument('--learning-rate', type=float, default=0.001,
@@ -299,6 +485,7 @@ class NuGraph3(LightningModule):
             vertex_aggr=args.vertex_aggr,
             vertex_lstm_features=args.vertex_lstm_feats,
             vertex_mlp_features=args.vertex_mlp_feats,
+            instance_features=args.instance_feats,
             planes=nudata.planes,
             semantic_classes=nudata.semantic_classes,
             event_classes=nudata.event_classes,
@@ -307,5 +494,12 @@ class NuGraph3(LightningModule):
             semantic_head=args.semantic,
             filter_head=args.filter,
             vertex_head=args.vertex,
+            instance_head=args.instance,
             checkpoint=not args.no_checkpointing,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_modules=args.checkpoint_modules,
+            checkpoint_budget=args.checkpoint_budget,
+            decompose=args.decompose_edges,
+            sparse_nexus=args.sparse_nexus,
+            metric_interval=args.metric_interval,
             lr=args.learning_rate)
@@ -1,2 +1,3 @@
 # __init__.py
 from .NuGraph3 import NuGraph3
+from .inference import InferenceModel, compile_inference, check_compiled, export_inference, load_inference
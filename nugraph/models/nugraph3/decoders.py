@@ -1,19 +1,35 @@
-from typing import Any, Callable
+from typing import Callable
 
 from abc import ABC
 
-from torch import Tensor, tensor, cat
+from torch import Tensor, tensor, cat, autocast, no_grad, zeros, long
 import torch.nn as nn
-from torch_geometric.nn.aggr import SoftmaxAggregation, LSTMAggregation
+from torch_geometric.nn.aggr import SoftmaxAggregation, LSTMAggregation, AttentionalAggregation
 from torch_geometric.nn.resolver import aggregation_resolver as aggr_resolver
 
 import torchmetrics as tm
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sn
 import math
 
-from ...util import RecallLoss, LogCoshLoss, ObjCondensationLoss
+from ...util import RecallLoss, LogCoshLoss, ObjCondensationLoss, condensation_clustering, log_figure
+
+class VertexResolution(tm.Metric):
+    '''Mean absolute vertex displacement along one axis, or combined'''
+    def __init__(self, axis: int = None):
+        super().__init__()
+        self.axis = axis
+        self.add_state('diff', default=zeros(3), dist_reduce_fx='sum')
+        self.add_state('num', default=tensor(0.), dist_reduce_fx='sum')
+
+    def update(self, x: Tensor, y: Tensor) -> None:
+        self.diff += (x - y).abs().sum(dim=0)
+        self.num += x.size(0)
+
+    def compute(self) -> Tensor:
+        xyz = self.diff / self.num
+        return xyz.square().sum().sqrt() if self.axis is None else xyz[self.axis]
 
 class DecoderBase(nn.Module, ABC):
     '''Base class for all NuGraph decoders'''
@@ -32,46 +48,70 @@ class DecoderBase(nn.Module, ABC):
         self.weight = weight
         self.temp = nn.Parameter(tensor(temperature))
         self.confusion = nn.ModuleDict()
+        self.stage_metrics = nn.ModuleDict()
 
     def arrange(self, batch) -> tuple[Tensor, Tensor]:
         raise NotImplementedError
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        raise NotImplementedError
+    def add_metrics(self, metrics: dict[str, tm.Metric]) -> None:
+        '''Register metrics, accumulated separately for each stage'''
+        collection = tm.MetricCollection(metrics)
+        for stage in ('train', 'val', 'test'):
+            # keyed by suffix, since 'train' clashes with nn.Module.train
+            self.stage_metrics[f'{stage}_metrics'] = collection.clone(postfix=f'/{stage}')
+
+    def compute_metrics(self, stage: str) -> dict[str, Tensor]:
+        '''Reduce and reset the metrics accumulated for a stage'''
+        key = f'{stage}_metrics'
+        if key not in self.stage_metrics:
+            return {}
+        metrics = self.stage_metrics[key].compute()
+        self.stage_metrics[key].reset()
+        return metrics
 
     def loss(self,
              batch,
              stage: str,
              confusion: bool = False):
         x, y = self.arrange(batch)
-        w = self.weight * (-1 * self.temp).exp()
-        loss = w * self.loss_func(x, y) + self.temp
+        # losses and metrics are always evaluated in full precision
+        with autocast(x.device.type, enabled=False):
+            x = x.float()
+            w = self.weight * (-1 * self.temp).exp()
+            loss = w * self.loss_func(x, y) + self.temp
+
+        # metrics are accumulated on device, and only reduced on request
         metrics = {}
         if stage:
-            metrics = self.metrics(x, y, stage)
-            metrics[f'loss_{self.name}/{stage}'] = loss
+            with no_grad():
+                x = x.detach()
+                key = f'{stage}_metrics'
+                if key in self.stage_metrics:
+                    self.stage_metrics[key].update(x, y)
+                if confusion:
+                    for cm in self.confusion.values():
+                        cm.update(x, y)
+            metrics[f'loss_{self.name}/{stage}'] = loss.detach()
             if stage == 'train':
-                metrics[f'temperature/{self.name}'] = self.temp
-            if confusion:
-                for cm in self.confusion.values():
-                    cm.update(x, y)
+                metrics[f'temperature/{self.name}'] = self.temp.detach()
         return loss, metrics
 
     def finalize(self, batch) -> None:
         return
 
-    def draw_confusion_matrix(self, cm: tm.ConfusionMatrix) -> plt.Figure:
+    def draw_confusion_matrix(self, confusion: Tensor) -> Figure:
         '''Produce confusion matrix at end of epoch'''
-        confusion = cm.compute().cpu()
-        fig = plt.figure(figsize=[8,6])
+        fig = Figure(figsize=[8,6])
+        ax = fig.add_subplot()
         sn.heatmap(confusion,
                    xticklabels=self.classes,
                    yticklabels=self.classes,
                    vmin=0, vmax=1,
-                   annot=True)
-        plt.ylim(0, len(self.classes))
-        plt.xlabel('Assigned label')
-        plt.ylabel('True label')
+                   annot=True,
+                   ax=ax)
+        ax.set_ylim(0, len(self.classes))
+        ax.set_xlabel('Assigned label')
+        ax.set_ylabel('True label')
         return fig
 
     def on_epoch_end(self,
@@ -79,11 +119,13 @@ class DecoderBase(nn.Module, ABC):
                      stage: str,
                      epoch: int) -> None:
         if not logger: return
+        # matrices are reduced here, and rendered off the training thread
         for name, cm in self.confusion.items():
-            logger.experiment.add_figure(
-                f'{name}/{stage}',
-                self.draw_confusion_matrix(cm),
-                global_step=epoch)
+            log_figure(logger,
+                       f'{name}/{stage}',
+                       self.draw_confusion_matrix,
+                       cm.compute().cpu(),
+                       global_step=epoch)
             cm.reset()
 
 class SemanticDecoder(DecoderBase):
@@ -109,8 +151,10 @@ class SemanticDecoder(DecoderBase):
             'ignore_index': -1
         }
 
-        self.recall = tm.Recall(**metric_args)
-        self.precision = tm.Precision(**metric_args)
+        self.add_metrics({
+            'recall_semantic': tm.Recall(**metric_args),
+            'precision_semantic': tm.Precision(**metric_args),
+        })
         self.confusion['recall_semantic_matrix'] = tm.ConfusionMatrix(
             normalize='true', **metric_args)
         self.confusion['precision_semantic_matrix'] = tm.ConfusionMatrix(
@@ -129,15 +173,9 @@ class SemanticDecoder(DecoderBase):
         y = cat([batch[p].y_semantic for p in self.planes], dim=0)
         return x, y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        return {
-            f'recall_semantic/{stage}': self.recall(x, y),
-            f'precision_semantic/{stage}': self.precision(x, y)
-        }
-
     def finalize(self, batch) -> None:
         for p in self.planes:
-            batch[p].x_semantic = batch[p].x_semantic.softmax(dim=1)
+            batch[p].x_semantic = batch[p].x_semantic.float().softmax(dim=1)
 
 class FilterDecoder(DecoderBase):
     """NuGraph filter decoder module.
@@ -160,8 +198,10 @@ class FilterDecoder(DecoderBase):
             'task': 'binary'
         }
 
-        self.recall = tm.Recall(**metric_args)
-        self.precision = tm.Precision(**metric_args)
+        self.add_metrics({
+            'recall_filter': tm.Recall(**metric_args),
+            'precision_filter': tm.Precision(**metric_args),
+        })
         self.confusion['recall_filter_matrix'] = tm.ConfusionMatrix(
             normalize='true', **metric_args)
         self.confusion['precision_filter_matrix'] = tm.ConfusionMatrix(
@@ -183,12 +223,6 @@ class FilterDecoder(DecoderBase):
         y = cat([(batch[p].y_semantic!=-1).float() for p in self.planes], dim=0)
         return x, y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        return {
-            f'recall_filter/{stage}': self.recall(x, y),
-            f'precision_filter/{stage}': self.precision(x, y)
-        }
-
 class EventDecoder(DecoderBase):
     '''NuGraph event decoder module.
 
@@ -211,8 +245,10 @@ class EventDecoder(DecoderBase):
             'num_classes': len(event_classes)
         }
 
-        self.recall = tm.Recall(**metric_args)
-        self.precision = tm.Precision(**metric_args)
+        self.add_metrics({
+            'recall_event': tm.Recall(**metric_args),
+            'precision_event': tm.Precision(**metric_args),
+        })
         self.confusion['recall_event_matrix'] = tm.ConfusionMatrix(
             normalize='true', **metric_args)
         self.confusion['precision_event_matrix'] = tm.ConfusionMatrix(
@@ -233,17 +269,16 @@ class EventDecoder(DecoderBase):
     def arrange(self, batch) -> tuple[Tensor, Tensor]:
         return batch['evt'].x, batch['evt'].y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        return {
-            f'recall_event/{stage}': self.recall(x, y),
-            f'precision_event/{stage}': self.precision(x, y)
-        }
-
     def finalize(self, batch) -> None:
-        batch['evt'].x = batch['evt'].x.softmax(dim=1)
+        batch['evt'].x = batch['evt'].x.float().softmax(dim=1)
 
 class VertexDecoder(DecoderBase):
-    """
+    """NuGraph vertex decoder module.
+
+    Pool graph node features in each plane, and regress the 3D position of
+    the interaction vertex. The default LSTM pooling runs sequentially over
+    each graph's nodes; 'attention' pooling is a faster alternative that
+    pools all nodes at once.
     """
     def __init__(self,
                  node_features: int,
@@ -259,6 +294,13 @@ class VertexDecoder(DecoderBase):
                          weight=1.,
                          temperature=5.)
 
+        self.add_metrics({
+            'vertex-resolution-x': VertexResolution(0),
+            'vertex-resolution-y': VertexResolution(1),
+            'vertex-resolution-z': VertexResolution(2),
+            'vertex-resolution': VertexResolution(),
+        })
+
         # initialise aggregation function
         self.aggr = nn.ModuleDict()
         aggr_kwargs = {}
@@ -269,8 +311,16 @@ class VertexDecoder(DecoderBase):
                 'out_channels': lstm_features,
             }
             in_features = lstm_features
+        elif aggr == 'attention':
+            in_features = lstm_features
         for p in self.planes:
-            self.aggr[p] = aggr_resolver(aggr, **(aggr_kwargs or {}))
+            if aggr == 'attention':
+                self.aggr[p] = AttentionalAggregation(
+                    gate_nn=nn.Linear(node_features, 1),
+                    nn=nn.Sequential(nn.Linear(node_features, lstm_features),
+                                     nn.ReLU()))
+            else:
+                self.aggr[p] = aggr_resolver(aggr, **(aggr_kwargs or {}))
 
         # initialise MLP
         net = []
@@ -282,8 +332,11 @@ class VertexDecoder(DecoderBase):
         self.net = nn.Sequential(*net)
 
     def forward(self, x: dict[str, Tensor], batch: dict[str, Tensor]) -> dict[str,dict[str, Tensor]]:
-        x = [ net(x[p], index=batch[p]) for p, net in self.aggr.items() ]
-        x = cat(x, dim=1)
+        # every plane is pooled into the same number of graphs
+        num_graphs = max(int(batch[p].max()) + 1 if batch[p].numel() else 0
+                         for p in self.planes)
+        x = cat([ net(x[p], index=batch[p], dim_size=num_graphs)
+                  for p, net in self.aggr.items() ], dim=1)
         return { 'x_vtx': { 'evt': self.net(x) }}
 
     def arrange(self, batch) -> tuple[Tensor, Tensor]:
@@ -291,46 +344,70 @@ class VertexDecoder(DecoderBase):
         y = batch['evt'].y_vtx
         return x, y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        xyz = (x-y).abs().mean(dim=0)
-        return {
-            f'vertex-resolution-x/{stage}': xyz[0],
-            f'vertex-resolution-y/{stage}': xyz[1],
-            f'vertex-resolution-z/{stage}': xyz[2],
-            f'vertex-resolution/{stage}': xyz.square().sum().sqrt()
-        }
-
 class InstanceDecoder(DecoderBase):
+    """NuGraph instance decoder module.
+
+    Embed each graph node in a clustering space, and predict a condensation
+    strength beta, trained with an object condensation loss. At inference,
+    nodes are clustered around condensation points to produce instance ids.
+    """
     def __init__(self,
                  node_features: int,
                  planes: list[str],
-                 classes: list[str]):
-        super().__init__('Instance',
+                 instance_features: int = 3,
+                 radius: float = 0.5,
+                 threshold: float = 0.1):
+        super().__init__('instance',
                          planes,
-                         event_classes,
-                         ObjCondensationLoss(),
-                         'multiclass',
-                         confusion=False)
-
-        num_features = len(classes) * node_features
+                         ('noise', 'instance'),
+                         self.condensation_loss,
+                         weight=1.)
+        self.condensation = ObjCondensationLoss()
+        self.radius = radius
+        self.threshold = threshold
 
         self.net = nn.ModuleDict()
         for p in planes:
-            self.net[p] = nn.Sequential(
-                nn.Linear(num_features, 1),
-                nn.Sigmoid())
+            self.net[p] = nn.Linear(node_features, instance_features + 1)
 
-    def forward(self, x: dict[str, Tensor], batch: dict[str, Tensor]) -> dict[str, dict[str, Tensor]]:
-        return {'x_instance': {p: self.net[p](x[p].flatten(start_dim=1)).squeeze(dim=-1) for p in self.net.keys()}}
+    def forward(self, x: dict[str, Tensor],
+                batch: dict[str, Tensor]) -> dict[str, dict[str, Tensor]]:
+        x = { p: self.net[p](x[p]) for p in self.planes }
+        return {
+            'x_instance': { p: t[:,1:] for p, t in x.items() },
+            'x_beta': { p: t[:,0].sigmoid() for p, t in x.items() },
+        }
+
+    def condensation_loss(self, x: Tensor, y: Tensor) -> Tensor:
+        beta = x[:,0].clamp(max=1-1e-4)
+        return self.condensation(x[:,1:], beta, y)
+
+    def graph_index(self, batch) -> Tensor:
+        '''Graph index of each node, concatenated across planes'''
+        return cat([batch[p].batch if 'batch' in batch[p] else
+                    zeros(batch[p].num_nodes, dtype=long, device=batch[p].x_beta.device)
+                    for p in self.planes], dim=0)
 
-    def arrange(self, batch: dict[str, Tensor]) -> tuple[Tensor, Tensor]:
-        x = torch.cat([batch[p]['x_instance'] for p in self.planes], dim=0)
-        y = torch.cat([batch[p]['y_instance'] for p in self.planes], dim=0)
+    def arrange(self, batch) -> tuple[Tensor, Tensor]:
+        x = cat([cat((batch[p].x_beta[:,None], batch[p].x_instance), dim=1)
+                 for p in self.planes], dim=0)
+        y = cat([batch[p].y_instance for p in self.planes], dim=0)
+
+        # instance ids restart in every graph, so offset them to keep
+        # instances from different graphs apart, leaving noise at -1
+        index = self.graph_index(batch)
+        num_graphs = getattr(batch, 'num_graphs', 1)
+        count = zeros(num_graphs, dtype=y.dtype, device=y.device)
+        count = count.scatter_reduce(0, index, y + 1, 'amax')
+        offset = count.cumsum(0) - count
+        y = (y + offset[index]).where(y >= 0, y)
         return x, y
 
-    def metrics(self, x: Tensor, y: Tensor, stage: str) -> dict[str, Any]:
-        metrics = {}
-        predictions = self.predict(x)
-        acc = self.acc_func(predictions, y)
-        metrics[f'{self.name}_accuracy/{stage}'] = accuracy
-        return metrics
+    def finalize(self, batch) -> None:
+        coords = cat([batch[p].x_instance.float() for p in self.planes], dim=0)
+        beta = cat([batch[p].x_beta.float() for p in self.planes], dim=0)
+        index = self.graph_index(batch)
+        instance = condensation_clustering(coords, beta, index,
+                                           self.radius, self.threshold)
+        for p, i in zip(self.planes, instance.split([batch[p].num_nodes for p in self.planes])):
+            batch[p].i_instance = i
@@ -0,0 +1,271 @@
+import math
+import warnings
+
+import torch
+from torch import Tensor, cat
+import torch.nn as nn
+from torch_geometric.data import Batch
+
+class InferenceModel(nn.Module):
+    '''Inference-only NuGraph module with a flat tensor signature
+
+    Inputs are lists of tensors ordered by plane instead of data objects, so
+    the module can be captured by torch.compile, torch.export and the ONNX
+    exporter. Outputs are the same nested dictionary returned by the model's
+    forward function. NuGraph2 models are also supported, since they differ
+    only in carrying a semantic class dimension on planar features.
+
+    If outputs is given as a list of (attribute, store) pairs, the selected
+    tensors are instead returned as a flat tuple, as the ONNX exporter
+    requires.'''
+    def __init__(self, model: 'NuGraph3',
+                 outputs: list[tuple[str, str]] = None):
+        super().__init__()
+        self.planes = list(model.planes)
+        self.outputs = outputs
+        self.num_iters = model.num_iters
+        self.encoder = model.encoder
+        self.plane_net = model.plane_net
+        self.nexus_net = model.nexus_net
+        self.decoders = nn.ModuleList(model.decoders)
+
+    def forward(self,
+                x: list[Tensor],
+                edge_index_plane: list[Tensor],
+                edge_index_nexus: list[Tensor],
+                nexus: Tensor,
+                batch: list[Tensor]) -> dict[str, dict[str, Tensor]]:
+        x = dict(zip(self.planes, x))
+        edge_index_plane = dict(zip(self.planes, edge_index_plane))
+        edge_index_nexus = dict(zip(self.planes, edge_index_nexus))
+        batch = dict(zip(self.planes, batch))
+        m = self.encoder(x)
+        for _ in range(self.num_iters):
+            for p in self.planes:
+                s = x[p]
+                if m[p].dim() > s.dim():
+                    s = s.unsqueeze(1).expand(-1, m[p].size(1), -1)
+                m[p] = cat((m[p], s), dim=-1)
+            self.plane_net(m, edge_index_plane)
+            self.nexus_net(m, edge_index_nexus, nexus)
+        ret = {}
+        for decoder in self.decoders:
+            ret.update(decoder(m, batch))
+        if self.outputs is not None:
+            return tuple(ret[attr][store] for attr, store in self.outputs)
+        return ret
+
+def unpack(batch: Batch, planes: list[str]) -> tuple:
+    '''Unpack a batch into InferenceModel arguments'''
+    return ([ batch[p].x for p in planes ],
+            [ batch[p, 'plane', p].edge_index for p in planes ],
+            [ batch[p, 'nexus', 'sp'].edge_index for p in planes ],
+            torch.empty(batch['sp'].num_nodes, 0),
+            [ batch[p].batch for p in planes ])
+
+def bucket(n: int, base: float = 2., minimum: int = 256) -> int:
+    '''Smallest bucket size strictly larger than n'''
+    return max(minimum, int(base ** math.ceil(math.log(n + 1, base) + 1e-9)))
+
+def input_sizes(x: list[Tensor],
+                edge_index_plane: list[Tensor],
+                edge_index_nexus: list[Tensor],
+                nexus: Tensor,
+                batch: list[Tensor]) -> list[int]:
+    '''Sizes of each padded dimension: planar nodes, planar edges and nexus
+    edges for each plane, followed by space points'''
+    return ([ t.size(0) for t in x ] +
+            [ t.size(1) for t in edge_index_plane ] +
+            [ t.size(1) for t in edge_index_nexus ] +
+            [ nexus.size(0) ])
+
+class SizeClasses:
+    '''Map every batch onto one of a geometric series of padded shapes
+
+    The size class of a batch is set by its total number of planar nodes.
+    Each padded dimension is a fixed fraction of that total, a power of the
+    base taken from the first batch, so all dimensions move between classes
+    together and each class is a single input shape. A batch whose
+    dimensions do not fit its class is promoted to the next one.'''
+    def __init__(self, num_planes: int, base: float = 2., minimum: int = 256):
+        self.num_planes = num_planes
+        self.base = base
+        self.minimum = minimum
+        self.ratios = None
+
+    def __call__(self, dims: list[int]) -> list[int]:
+        '''Padded size of each dimension, each strictly larger than its
+        unpadded size'''
+        total = max(sum(dims[:self.num_planes]), 1)
+        if self.ratios is None:
+            self.ratios = [ self.base ** math.ceil(math.log(max(d, 1) / total, self.base))
+                            for d in dims ]
+        size = bucket(total, self.base, self.minimum)
+        while True:
+            capacity = [ max(int(size * r), 1) for r in self.ratios ]
+            if all(d < c for d, c in zip(dims, capacity)):
+                return capacity
+            size = int(size * self.base)
+
+def pad(x: list[Tensor],
+        edge_index_plane: list[Tensor],
+        edge_index_nexus: list[Tensor],
+        nexus: Tensor,
+        batch: list[Tensor],
+        num_graphs: int,
+        capacity: list[int]) -> tuple:
+    '''Pad inputs up to the given dimension sizes to limit recompilation
+
+    Padding nodes are only connected to each other and to padding space
+    points, and are assigned to an additional graph, so they never contribute
+    to the outputs of real nodes or graphs.'''
+    num_planes = len(x)
+    nodes = capacity[:num_planes]
+    plane_edges = capacity[num_planes:2*num_planes]
+    nexus_edges = capacity[2*num_planes:3*num_planes]
+    num_sp = nexus.size(0)
+    nexus = nexus.new_empty(capacity[-1], 0)
+    x_pad, plane_pad, nexus_pad, batch_pad = [], [], [], []
+    for i, (x_p, ei_p, en_p, b_p) in enumerate(zip(x, edge_index_plane, edge_index_nexus, batch)):
+        n = x_p.size(0)
+        x_pad.append(torch.cat((x_p, x_p.new_zeros(nodes[i]-n, x_p.size(1)))))
+        batch_pad.append(torch.cat((b_p, b_p.new_full((nodes[i]-n,), num_graphs))))
+        e = ei_p.size(1)
+        plane_pad.append(torch.cat((ei_p, ei_p.new_full((2, plane_edges[i]-e), n)), dim=1))
+        e = en_p.size(1)
+        fill = en_p.new_tensor([[n], [num_sp]]).expand(-1, nexus_edges[i]-e)
+        nexus_pad.append(torch.cat((en_p, fill), dim=1))
+    return x_pad, plane_pad, nexus_pad, nexus, batch_pad
+
+def unpad(out: dict[str, dict[str, Tensor]],
+          sizes: dict[str, int]) -> dict[str, dict[str, Tensor]]:
+    '''Remove padding from model outputs'''
+    return { attr: { store: t[:sizes[store]] for store, t in stores.items() }
+             for attr, stores in out.items() }
+
+class CompiledNuGraph3:
+    '''Run NuGraph3 inference through torch.compile
+
+    With bucketing enabled, each batch is padded up to one of a geometric
+    series of size classes, which fixes every node, edge and space point
+    count at once, so there is one input shape (and one compilation) per
+    size class.
+
+    Dynamo keeps one compiled graph per input shape, up to its cache size
+    limit, beyond which it silently falls back to eager mode. The limit is
+    raised to cover max_classes size classes, and batches that would need
+    a size class beyond that run in eager mode with a warning.'''
+    def __init__(self,
+                 model: 'NuGraph3',
+                 bucketing: bool = True,
+                 base: float = 2.,
+                 max_classes: int = 16,
+                 **kwargs):
+        self.planes = list(model.planes)
+        self.bucketing = bucketing
+        self.classes = SizeClasses(len(self.planes), base)
+        self.max_classes = max_classes
+        self.compiled = set()
+        self.model = InferenceModel(model).eval()
+        if bucketing:
+            config = torch._dynamo.config
+            config.cache_size_limit = max(config.cache_size_limit, max_classes)
+            if hasattr(config, 'accumulated_cache_size_limit'):
+                config.accumulated_cache_size_limit = max(
+                    config.accumulated_cache_size_limit, max_classes)
+        self.fn = torch.compile(self.model, dynamic=not bucketing, **kwargs)
+
+    @torch.inference_mode()
+    def __call__(self, batch: Batch) -> dict[str, dict[str, Tensor]]:
+        args = unpack(batch, self.planes)
+        if not self.bucketing:
+            return self.fn(*args)
+        sizes = { p: batch[p].num_nodes for p in self.planes }
+        sizes['evt'] = batch.num_graphs
+        capacity = self.classes(input_sizes(*args))
+        fn = self.fn
+        if tuple(capacity) not in self.compiled:
+            if len(self.compiled) < self.max_classes:
+                self.compiled.add(tuple(capacity))
+            else:
+                warnings.warn(f'batch needs more than {self.max_classes} size classes, so it runs in eager mode')
+                fn = self.model
+        out = fn(*pad(*args, batch.num_graphs, capacity))
+        return unpad(out, sizes)
+
+def compile_inference(model: 'NuGraph3', **kwargs) -> CompiledNuGraph3:
+    '''Compile a NuGraph3 model for inference'''
+    return CompiledNuGraph3(model, **kwargs)
+
+def check_compiled(model: 'NuGraph3',
+                   batches: list[Batch],
+                   atol: float = 1e-5,
+                   **kwargs) -> None:
+    '''Compare compiled against eager outputs over a set of batches
+
+    Batches of different sizes exercise padding to several size classes.'''
+    compiled = compile_inference(model.cpu(), **kwargs)
+    with torch.inference_mode():
+        for batch in batches:
+            batch = batch.cpu()
+            expected = compiled.model(*unpack(batch, compiled.planes))
+            check_parity(expected, compiled(batch), atol)
+
+def check_exportable(out: dict[str, dict[str, Tensor]], planes: list[str]) -> None:
+    '''Raise if model outputs include any that are not node-level
+
+    Event-level heads compute their output size from the data, which cannot
+    be captured by torch.export or traced for ONNX, so only node-level heads
+    can be exported.'''
+    for attr, stores in out.items():
+        for store in stores:
+            if store not in planes:
+                raise ValueError(f'"{attr}" is not a node-level output and cannot be exported, use compile_inference instead')
+
+def export_inference(model: 'NuGraph3',
+                     batch: Batch,
+                     path: str,
+                     check: bool = True,
+                     atol: float = 1e-5) -> None:
+    '''Export a NuGraph3 model to a self-contained torch.export archive
+
+    The exported program has dynamic node, edge and space point dimensions,
+    and can be loaded for CPU inference with load_inference without the
+    nugraph package. If check is set, exported outputs are compared against
+    eager mode on the example batch.'''
+    module = InferenceModel(model.cpu()).eval()
+    args = unpack(batch.cpu(), module.planes)
+    with torch.no_grad():
+        expected = module(*args)
+    check_exportable(expected, module.planes)
+
+    Dim = torch.export.Dim
+    nodes = [ Dim(f'num_nodes_{p}') for p in module.planes ]
+    dynamic_shapes = {
+        'x': [ {0: n} for n in nodes ],
+        'edge_index_plane': [ {1: Dim(f'num_edges_plane_{p}')} for p in module.planes ],
+        'edge_index_nexus': [ {1: Dim(f'num_edges_nexus_{p}')} for p in module.planes ],
+        'nexus': {0: Dim('num_sp')},
+        'batch': [ {0: n} for n in nodes ],
+    }
+
+    with torch.no_grad():
+        program = torch.export.export(module, args, dynamic_shapes=dynamic_shapes)
+        if check:
+            check_parity(expected, program.module()(*args), atol)
+    torch.export.save(program, path)
+
+def load_inference(path: str) -> nn.Module:
+    '''Load an exported NuGraph3 model for CPU inference'''
+    return torch.export.load(path).module()
+
+def check_parity(expected: dict[str, dict[str, Tensor]],
+                 actual: dict[str, dict[str, Tensor]],
+                 atol: float = 1e-5,
+                 backend: str = 'eager mode') -> None:
+    '''Raise if two sets of model outputs differ'''
+    for attr, stores in expected.items():
+        for store, t in stores.items():
+            diff = (t - actual[attr][store]).abs().max().item()
+            if diff > atol:
+                raise RuntimeError(f'{attr} output for {store} differs from {backend} by {diff}')
@@ -1,11 +1,15 @@
 from typing import Any, Callable
 
+import torch
 from torch import Tensor, cat
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.checkpoint import checkpoint
 
 from torch_geometric.nn import MessagePassing, SimpleConv
 
+from ...util import CheckpointPolicy
+
 class NexusDown(MessagePassing):
     def __init__(self,
                  planar_features: int,
@@ -36,6 +40,109 @@ class NexusDown(MessagePassing):
     def update(self, aggr_out: Tensor, x: Tensor) -> Tensor:
         return self.node_net(cat((x, aggr_out), dim=-1))
 
+    def edge_weight(self, x: Tensor, edge_index: Tensor, n: Tensor) -> Tensor:
+        '''Scalar weight of each edge, as applied to messages'''
+        x_i, n_j = x[edge_index[0]], n[edge_index[1]]
+        return self.edge_net(cat((x_i, n_j), dim=-1).detach()).squeeze(-1)
+
+class DecomposedNexusDown(NexusDown):
+    '''Memory-efficient equivalent of NexusDown
+
+    Planar and nexus nodes are each projected once through their half of the
+    first edge network layer, and the scalar projections are summed per edge
+    instead of concatenating features for every edge.'''
+    def forward(self, x: Tensor, edge_index: Tensor, n: Tensor) -> Tensor:
+        lin = self.edge_net[0]
+        f = x.size(-1)
+        e_x = F.linear(x.detach(), lin.weight[:, :f], lin.bias)
+        e_n = F.linear(n.detach(), lin.weight[:, f:])
+        return self.propagate(edge_index=edge_index, x=x, n=n, e_x=e_x, e_n=e_n)
+
+    def message(self, n_j: Tensor, e_x_i: Tensor, e_n_j: Tensor) -> Tensor:
+        return self.edge_net[1](e_x_i + e_n_j) * n_j
+
+    def edge_weight(self, x: Tensor, edge_index: Tensor, n: Tensor) -> Tensor:
+        lin = self.edge_net[0]
+        f = x.size(-1)
+        e_x = F.linear(x.detach(), lin.weight[:, :f], lin.bias)
+        e_n = F.linear(n.detach(), lin.weight[:, f:])
+        return self.edge_net[1](e_x[edge_index[0]] + e_n[edge_index[1]]).squeeze(-1)
+
+class NexusProjection:
+    '''Sparse incidence between planar nodes and space points for a batch
+
+    Built once per batch from the plane-to-nexus edges, and reused by every
+    message-passing iteration. Projecting all planes up to space points is a
+    single sparse CSR matmul, and projecting back down is a single sparse
+    matmul whose values are the per-edge weights, normalised by node degree
+    for mean aggregation. Since those values carry gradients, the down
+    projection uses a coalesced COO layout, which autograd supports.'''
+    def __init__(self,
+                 edge_index: dict[str, Tensor],
+                 num_nodes: dict[str, int],
+                 num_sp: int,
+                 mean: bool = True):
+        self.planes = list(edge_index)
+        self.num_nodes = [ num_nodes[p] for p in self.planes ]
+        self.num_sp = num_sp
+        total = sum(self.num_nodes)
+        offsets = torch.tensor([0] + self.num_nodes[:-1]).cumsum(0).tolist()
+        node = cat([ e[0] + o for e, o in zip(edge_index.values(), offsets) ])
+        sp = cat(list(edge_index.values()), dim=1)[1]
+        plane = cat([ torch.full_like(e[0], i) for i, e in enumerate(edge_index.values()) ])
+
+        # sum each plane's nodes into its own block of space point rows
+        up = torch.sparse_coo_tensor(torch.stack((plane * num_sp + sp, node)),
+                                     torch.ones(node.size(0), device=node.device),
+                                     (len(self.planes) * num_sp, total))
+        self.up_matrix = up.coalesce().to_sparse_csr()
+
+        # order edges by planar node then space point for the down projection
+        self.perm = (node * num_sp + sp).argsort()
+        self.index = torch.stack((node[self.perm], sp[self.perm]))
+        self.coalesced = bool((self.index.diff(dim=1) != 0).any(dim=0).all())
+        self.norm = None
+        if mean:
+            deg = torch.bincount(node, minlength=total).clamp(min=1)
+            self.norm = 1. / deg[self.index[0]]
+
+    def up(self, x: dict[str, Tensor]) -> Tensor:
+        '''Sum planar node features into space points, concatenated by plane'''
+        h = cat([ x[p] for p in self.planes ], dim=0)
+        up = self.up_matrix if self.up_matrix.dtype == h.dtype else self.up_matrix.to(h.dtype)
+        n = up @ h
+        return n.view(len(self.planes), self.num_sp, -1).transpose(0, 1).flatten(1)
+
+    def down(self, weight: dict[str, Tensor], n: Tensor) -> dict[str, Tensor]:
+        '''Aggregate weighted space point features into each planar node'''
+        values = cat([ weight[p] for p in self.planes ])[self.perm]
+        if self.norm is not None:
+            values = values * self.norm
+        adj = torch.sparse_coo_tensor(self.index, values.to(n.dtype),
+                                      (sum(self.num_nodes), self.num_sp),
+                                      is_coalesced=self.coalesced)
+        if not self.coalesced:
+            adj = adj.coalesce()
+        out = torch.sparse.mm(adj, n)
+        return dict(zip(self.planes, out.split(self.num_nodes)))
+
+class SparseNexusUp(nn.Module):
+    '''Project planar node features up to space points through a sparse
+    nexus projection. It holds no parameters, and exists so the projection
+    runs as a module call that can be hooked, like its dense counterpart.'''
+    def forward(self, projection: NexusProjection, x: dict[str, Tensor]) -> Tensor:
+        return projection.up(x)
+
+class SparseNexusDown(nn.Module):
+    '''Aggregate weighted space point features into each plane through a
+    sparse nexus projection, ahead of each plane's node update'''
+    def forward(self, projection: NexusProjection, nexus_down: nn.ModuleDict,
+                x: dict[str, Tensor], edge_index: dict[str, Tensor],
+                n: Tensor) -> dict[str, Tensor]:
+        w = { p: down.edge_weight(x[p], edge_index[p], n)
+              for p, down in nexus_down.items() }
+        return projection.down(w, n)
+
 class NexusNet(nn.Module):
     '''Module to project to nexus space and mix detector planes'''
     def __init__(self,
@@ -43,12 +150,16 @@ class NexusNet(nn.Module):
                  nexus_features: int,
                  planes: list[str],
                  aggr: str = 'mean',
-                 checkpoint: bool = True):
+                 checkpoint: CheckpointPolicy = None,
+                 decompose: bool = False):
         super().__init__()
 
         self.checkpoint = checkpoint
+        self.aggr = aggr
 
         self.nexus_up = SimpleConv(node_dim=0)
+        self.sparse_up = SparseNexusUp()
+        self.sparse_down = SparseNexusDown()
 
         self.nexus_net = nn.Sequential(
             nn.Linear(len(planes)*planar_features, nexus_features),
@@ -57,28 +168,48 @@ class NexusNet(nn.Module):
             nn.Tanh(),
         )
 
+        down = DecomposedNexusDown if decompose else NexusDown
         self.nexus_down = nn.ModuleDict()
         for p in planes:
-            self.nexus_down[p] = NexusDown(planar_features,
-                                           nexus_features,
-                                           aggr)
+            self.nexus_down[p] = down(planar_features,
+                                      nexus_features,
+                                      aggr)
 
     def ckpt(self, fn: Callable, *args) -> Any:
-        if self.checkpoint and self.training:
+        if self.training and self.checkpoint and self.checkpoint('nexus'):
             return checkpoint(fn, *args)
         else:
             return fn(*args)
 
-    def forward(self, x: dict[str, Tensor], edge_index: dict[str, Tensor], nexus: Tensor) -> None:
+    def projection(self, edge_index: dict[str, Tensor],
+                   x: dict[str, Tensor], nexus: Tensor) -> NexusProjection:
+        '''Precompute sparse nexus projections for a batch'''
+        if self.aggr not in ('mean', 'add', 'sum'):
+            raise Exception(f'sparse nexus projection does not support "{self.aggr}" aggregation')
+        return NexusProjection({ p: edge_index[p] for p in self.nexus_down },
+                               { p: x[p].size(0) for p in self.nexus_down },
+                               nexus.size(0), self.aggr == 'mean')
+
+    def forward(self, x: dict[str, Tensor], edge_index: dict[str, Tensor], nexus: Tensor,
+                projection: NexusProjection = None) -> None:
 
         # project up to nexus space
-        n = [None] * len(self.nexus_down)
-        for i, p in enumerate(self.nexus_down):
-            n[i] = self.nexus_up(x=(x[p], nexus), edge_index=edge_index[p])
+        if projection is not None:
+            n = self.sparse_up(projection, x)
+        else:
+            n = [None] * len(self.nexus_down)
+            for i, p in enumerate(self.nexus_down):
+                n[i] = self.nexus_up(x=(x[p], nexus), edge_index=edge_index[p])
+            n = cat(n, dim=-1)
 
         # convolve in nexus space
-        n = self.ckpt(self.nexus_net, cat(n, dim=-1))
+        n = self.ckpt(self.nexus_net, n)
 
         # project back down to planes
-        for p in self.nexus_down:
-            x[p] = self.ckpt(self.nexus_down[p], x[p], edge_index[p], n)
+        if projection is not None:
+            aggr = self.sparse_down(projection, self.nexus_down, x, edge_index, n)
+            for p, down in self.nexus_down.items():
+                x[p] = self.ckpt(down.update, aggr[p], x[p])
+        else:
+            for p in self.nexus_down:
+                x[p] = self.ckpt(self.nexus_down[p], x[p], edge_index[p], n)
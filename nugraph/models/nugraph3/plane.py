@@ -2,10 +2,13 @@ from typing import Any, Callable
 
 from torch import Tensor, cat
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.utils.checkpoint import checkpoint
 
 from torch_geometric.nn import MessagePassing
 
+from ...util import CheckpointPolicy
+
 class MessagePassing2D(MessagePassing):
 
     propagate_type = { 'x': Tensor }
@@ -39,6 +42,28 @@ class MessagePassing2D(MessagePassing):
     def update(self, aggr_out: Tensor, x: Tensor):
         return self.node_net(cat((x, aggr_out), dim=-1))
 
+class DecomposedMessagePassing2D(MessagePassing2D):
+    '''Memory-efficient equivalent of MessagePassing2D
+
+    The first edge network layer is linear, so rather than concatenating
+    features for every edge, each node is projected once through the two
+    halves of its weight matrix and the scalar projections are summed per
+    edge. Parameters are identical to MessagePassing2D.'''
+
+    propagate_type = { 'x': Tensor, 'e_dst': Tensor, 'e_src': Tensor }
+
+    def forward(self, x: Tensor, edge_index: Tensor):
+        lin = self.edge_net[0]
+        w_dst, w_src = lin.weight.chunk(2, dim=-1)
+        h = x.detach()
+        return self.propagate(edge_index, x=x,
+                              e_dst=F.linear(h, w_dst, lin.bias),
+                              e_src=F.linear(h, w_src),
+                              size=None)
+
+    def message(self, x_j: Tensor, e_dst_i: Tensor, e_src_j: Tensor):
+        return self.edge_net[1](e_dst_i + e_src_j) * x_j
+
 class PlaneNet(nn.Module):
     '''Module to convolve within each detector plane'''
     def __init__(self,
@@ -46,19 +71,21 @@ class PlaneNet(nn.Module):
                  planar_features: int,
                  planes: list[str],
                  aggr: str = 'add',
-                 checkpoint: bool = True):
+                 checkpoint: CheckpointPolicy = None,
+                 decompose: bool = False):
         super().__init__()
 
         self.checkpoint = checkpoint
 
+        mp = DecomposedMessagePassing2D if decompose else MessagePassing2D
         self.net = nn.ModuleDict()
         for p in planes:
-            self.net[p] = MessagePassing2D(in_features,
-                                           planar_features,
-                                           aggr)
+            self.net[p] = mp(in_features,
+                             planar_features,
+                             aggr)
 
     def ckpt(self, fn: Callable, *args) -> Any:
-        if self.checkpoint and self.training:
+        if self.training and self.checkpoint and self.checkpoint('plane'):
             return checkpoint(fn, *args)
         else:
             return fn(*args)
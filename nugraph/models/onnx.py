@@ -0,0 +1,92 @@
+import torch
+from torch import Tensor
+import torch.nn as nn
+from torch_geometric.data import Batch
+
+from .nugraph3.inference import InferenceModel, unpack, check_exportable, check_parity
+
+def input_names(planes: list[str]) -> list[str]:
+    '''Names of model inputs, in the order unpack returns them'''
+    return [ f'x_{p}' for p in planes ] \
+         + [ f'edge_index_plane_{p}' for p in planes ] \
+         + [ f'edge_index_nexus_{p}' for p in planes ] \
+         + [ 'nexus' ] \
+         + [ f'batch_{p}' for p in planes ]
+
+def flatten(args: tuple) -> list[Tensor]:
+    '''Flatten unpacked model inputs into a list of tensors'''
+    ret = []
+    for arg in args:
+        ret.extend(arg if isinstance(arg, list) else [arg])
+    return ret
+
+def export_onnx(model: nn.Module,
+                batch: Batch,
+                path: str,
+                opset: int = 17,
+                check: bool = True,
+                atol: float = 1e-4) -> None:
+    '''Export a NuGraph2 or NuGraph3 model to ONNX
+
+    Node, edge and space point dimensions are exported as dynamic axes. If
+    check is set, the exported model is run through onnxruntime on the
+    example batch and compared against PyTorch.'''
+    model = model.cpu().eval()
+    module = InferenceModel(model).eval()
+    args = unpack(batch.cpu(), module.planes)
+    with torch.no_grad():
+        expected = module(*args)
+    check_exportable(expected, module.planes)
+    module.outputs = [ (attr, store) for attr, stores in expected.items()
+                       for store in stores ]
+
+    dynamic_axes = {}
+    for p in module.planes:
+        dynamic_axes[f'x_{p}'] = {0: f'num_nodes_{p}'}
+        dynamic_axes[f'edge_index_plane_{p}'] = {1: f'num_edges_plane_{p}'}
+        dynamic_axes[f'edge_index_nexus_{p}'] = {1: f'num_edges_nexus_{p}'}
+        dynamic_axes[f'batch_{p}'] = {0: f'num_nodes_{p}'}
+    dynamic_axes['nexus'] = {0: 'num_sp'}
+    output_names = []
+    for attr, p in module.outputs:
+        output_names.append(f'{attr}_{p}')
+        dynamic_axes[output_names[-1]] = {0: f'num_nodes_{p}'}
+
+    torch.onnx.export(module, args, path,
+                      input_names=input_names(module.planes),
+                      output_names=output_names,
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset)
+
+    if check:
+        check_parity(expected, OnnxModel(path, model)(batch.cpu()), atol, 'PyTorch')
+
+class OnnxModel:
+    '''Run NuGraph inference through an onnxruntime CPU session'''
+    def __init__(self, path: str, model: nn.Module, threads: int = 0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options,
+                                            providers=['CPUExecutionProvider'])
+        self.model = model
+        self.planes = list(model.planes)
+        self.inputs = { i.name for i in self.session.get_inputs() }
+        self.outputs = [ o.name for o in self.session.get_outputs() ]
+
+    def __call__(self, batch: Batch) -> dict[str, dict[str, Tensor]]:
+        args = flatten(unpack(batch, self.planes))
+        feed = { name: t.cpu().numpy()
+                 for name, t in zip(input_names(self.planes), args)
+                 if name in self.inputs }
+        ret = {}
+        for name, out in zip(self.outputs, self.session.run(self.outputs, feed)):
+            attr, p = name.rsplit('_', 1)
+            ret.setdefault(attr, {})[p] = torch.from_numpy(out)
+        return ret
+
+    def predict_step(self, batch: Batch) -> Batch:
+        self.model.attach(batch, self(batch))
+        for decoder in self.model.decoders:
+            decoder.finalize(batch)
+        return batch
@@ -0,0 +1,49 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization as tq
+from torch.utils.data import Dataset, Subset
+from torch_geometric.loader import DataLoader
+
+def quantizable(model: nn.Module) -> list[str]:
+    '''Names of linear layers to quantize
+
+    Edge networks are left in float32, since the decomposed formulation
+    uses their weights directly and their cost is dominated by gathers.'''
+    return [ name for name, module in model.named_modules()
+             if isinstance(module, nn.Linear) and 'edge_net' not in name ]
+
+def quantize_dynamic(model: nn.Module) -> nn.Module:
+    '''Quantize linear layer weights to int8, with activations quantized
+    on the fly at inference time'''
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = { name: tq.default_dynamic_qconfig for name in quantizable(model) }
+    return tq.quantize_dynamic(model, qconfig, dtype=torch.qint8)
+
+def quantize_static(model: nn.Module,
+                    dataset: Dataset,
+                    num_samples: int = 256,
+                    batch_size: int = 64) -> nn.Module:
+    '''Quantize linear layer weights and activations to int8
+
+    Each linear layer is wrapped in quantize/dequantize stubs, and activation
+    ranges are calibrated by running inference over the first num_samples
+    graphs in the dataset.'''
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for name in quantizable(model):
+        parent, _, attr = name.rpartition('.')
+        parent = model.get_submodule(parent)
+        wrapper = tq.QuantWrapper(getattr(parent, attr))
+        wrapper.qconfig = qconfig
+        setattr(parent, attr, wrapper)
+    tq.prepare(model, inplace=True)
+
+    # calibrate activation observers
+    samples = Subset(dataset, range(min(num_samples, len(dataset))))
+    with torch.no_grad():
+        for batch in DataLoader(samples, batch_size=batch_size):
+            model.step(batch)
+
+    return tq.convert(model, inplace=True)
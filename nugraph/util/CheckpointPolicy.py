@@ -0,0 +1,82 @@
+class CheckpointPolicy:
+    '''Select which message-passing iterations and submodules to checkpoint
+
+    By default every k-th iteration of the requested submodules ('plane'
+    and/or 'nexus') is checkpointed. If a memory budget in bytes is given,
+    the activation memory of each submodule is estimated from the batch's
+    node and edge counts, and the fewest, most expensive submodule
+    iterations are checkpointed to bring the estimate within budget.
+
+    The model sets the current iteration before each message-passing step.'''
+    def __init__(self,
+                 in_features: int,
+                 planar_features: int,
+                 nexus_features: int,
+                 num_iters: int,
+                 every: int = 1,
+                 modules: list[str] = ['plane', 'nexus'],
+                 budget: float = None,
+                 bytes_per_element: int = 4):
+        self.in_features = in_features
+        self.planar_features = planar_features
+        self.nexus_features = nexus_features
+        self.num_iters = num_iters
+        self.every = every
+        self.modules = list(modules)
+        self.budget = budget
+        self.bytes_per_element = bytes_per_element
+        self.iteration = 0
+        self.selected = None
+
+    def cost(self,
+             module: str,
+             num_nodes: dict[str, int],
+             num_edges_plane: dict[str, int],
+             num_edges_nexus: dict[str, int],
+             num_sp: int) -> float:
+        '''Approximate activation memory of one iteration of a submodule'''
+        f_in = self.in_features + self.planar_features
+        f_p = self.planar_features
+        f_n = self.nexus_features
+        elements = 0
+        if module == 'plane':
+            for p, n in num_nodes.items():
+                # gathered endpoints, edge net input and messages per edge
+                elements += num_edges_plane[p] * (5 * f_in + 1)
+                # node net input and hidden layers per node
+                elements += n * (2 * f_in + 4 * f_p)
+        elif module == 'nexus':
+            # nexus net input and hidden layers per space point
+            elements += num_sp * (len(num_nodes) * f_p + 4 * f_n)
+            for p, n in num_nodes.items():
+                # upward gather and downward edge net per edge
+                elements += num_edges_nexus[p] * (3 * (f_p + f_n) + 1)
+                elements += n * (2 * (f_p + f_n) + 4 * f_p)
+        return elements * self.bytes_per_element
+
+    def configure(self,
+                  num_nodes: dict[str, int],
+                  num_edges_plane: dict[str, int],
+                  num_edges_nexus: dict[str, int],
+                  num_sp: int) -> None:
+        '''Select submodule iterations to checkpoint for the current batch'''
+        if self.budget is None:
+            return
+        costs = { m: self.cost(m, num_nodes, num_edges_plane, num_edges_nexus, num_sp)
+                  for m in self.modules }
+        total = self.num_iters * sum(costs.values())
+        candidates = sorted(((costs[m], i, m) for i in range(self.num_iters)
+                             for m in self.modules), reverse=True)
+        self.selected = set()
+        for cost, i, m in candidates:
+            if total <= self.budget:
+                break
+            self.selected.add((i, m))
+            total -= cost
+
+    def __call__(self, module: str) -> bool:
+        if module not in self.modules:
+            return False
+        if self.selected is not None:
+            return (self.iteration, module) in self.selected
+        return self.iteration % self.every == 0
@@ -0,0 +1,40 @@
+import os
+
+import torch
+
+class CpuAffinity:
+    '''Pin each local process to its own block of CPU cores
+
+    Available cores are split into contiguous blocks, one per local rank,
+    so ranks on a many-core node do not oversubscribe cores or contend
+    across sockets. Each rank runs as many intra-op threads as it has
+    cores, unless a thread count is given.
+
+    Changing affinity only moves the calling thread, so pin() must be called
+    at process start, before torch starts its intra-op worker threads, which
+    then inherit the rank's cores. The local rank is read from LOCAL_RANK,
+    which is unset in the launching process, so it is rank zero. The full
+    core list is passed to launched processes through NUGRAPH_CPU_CORES,
+    since they would otherwise inherit rank zero's block.'''
+    def __init__(self, num_local: int, threads: int = None):
+        self.num_local = max(num_local, 1)
+        self.threads = threads
+
+    def pin(self) -> list[int]:
+        '''Pin this process to its block of cores, and return the block'''
+        if not hasattr(os, 'sched_setaffinity'):
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            return []
+        if 'NUGRAPH_CPU_CORES' in os.environ:
+            cores = [ int(c) for c in os.environ['NUGRAPH_CPU_CORES'].split(',') ]
+        else:
+            cores = sorted(os.sched_getaffinity(0))
+            os.environ['NUGRAPH_CPU_CORES'] = ','.join(map(str, cores))
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        per_rank = max(len(cores) // self.num_local, 1)
+        start = (local_rank * per_rank) % len(cores)
+        mine = cores[start:start+per_rank]
+        os.sched_setaffinity(0, mine)
+        torch.set_num_threads(self.threads or len(mine))
+        return mine
@@ -0,0 +1,122 @@
+import multiprocessing
+
+import torch
+from torch_geometric.data import HeteroData
+
+from .CheckpointPolicy import CheckpointPolicy
+from .PeakRSS import PeakRSS
+
+Counts = tuple[dict[str, int], dict[str, int], dict[str, int], int]
+
+def peak_rss(model: 'pl.LightningModule', data: HeteroData, train: bool) -> float:
+    '''Growth in resident memory in bytes during a single CPU step'''
+    model.train(train)
+    with PeakRSS() as rss, torch.set_grad_enabled(train):
+        loss, _ = model.step(data)
+        if train:
+            loss.backward()
+    return rss.peak - rss.base
+
+class MemoryModel:
+    '''Predict peak training and inference memory from batch sizes
+
+    Activation memory for a batch is estimated analytically from its
+    per-plane node and edge counts and the model widths. A linear map from
+    that estimate to measured peak memory is then fitted separately for
+    training and inference from a few calibration steps, which absorbs
+    decoder heads, checkpointing and allocator overheads of the actual
+    model configuration.'''
+    def __init__(self,
+                 in_features: int,
+                 planar_features: int,
+                 nexus_features: int,
+                 num_iters: int,
+                 planes: list[str]):
+        self.policy = CheckpointPolicy(in_features, planar_features,
+                                       nexus_features, num_iters)
+        self.num_iters = num_iters
+        self.planes = planes
+        self.coef = {}
+
+    @classmethod
+    def from_model(cls, model: 'pl.LightningModule') -> 'MemoryModel':
+        hp = model.hparams
+        return cls(hp.in_features, hp.planar_features, hp.nexus_features,
+                   hp.num_iters, list(model.planes))
+
+    def counts(self, data: HeteroData) -> Counts:
+        '''Per-plane node and edge counts, and number of space points'''
+        return ({ p: data[p].num_nodes for p in self.planes },
+                { p: data[p, 'plane', p].num_edges for p in self.planes },
+                { p: data[p, 'nexus', 'sp'].num_edges for p in self.planes },
+                data['sp'].num_nodes)
+
+    @staticmethod
+    def add(a: Counts, b: Counts) -> Counts:
+        '''Counts for two graphs batched together'''
+        return tuple({ p: x[p] + y[p] for p in x } for x, y in zip(a[:3], b[:3])) \
+            + (a[3] + b[3],)
+
+    @staticmethod
+    def scale(counts: Counts, n: int) -> Counts:
+        '''Counts for n copies of the same graph batched together'''
+        return tuple({ p: n * x[p] for p in x } for x in counts[:3]) \
+            + (n * counts[3],)
+
+    def activations(self, counts: Counts) -> float:
+        '''Analytic estimate of activation memory in bytes'''
+        return self.num_iters * sum(self.policy.cost(m, *counts)
+                                    for m in ('plane', 'nexus'))
+
+    def measure(self, model: 'pl.LightningModule',
+                data: HeteroData, train: bool) -> float:
+        '''Peak memory in bytes of a single training or inference step
+
+        On CPU, the allocator keeps memory freed by earlier steps, which
+        would hide part of the growth of later ones. Each CPU step is
+        therefore measured in a freshly spawned process.'''
+        device = model.device
+        if device.type != 'cuda':
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(1) as pool:
+                return pool.apply(peak_rss, (model, data.clone(), train))
+        data = data.clone().to(device)
+        model.train(train)
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        with torch.set_grad_enabled(train):
+            loss, _ = model.step(data)
+            if train:
+                loss.backward()
+                model.zero_grad()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    def fit(self, counts: list[Counts], peaks: list[float], stage: str) -> None:
+        '''Fit offset and scale of the analytic estimate to measured peaks'''
+        a = torch.tensor([ self.activations(c) for c in counts ], dtype=torch.float64)
+        y = torch.tensor(peaks, dtype=torch.float64)
+        A = torch.stack((torch.ones_like(a), a), dim=1)
+        offset, scale = torch.linalg.lstsq(A, y[:,None]).solution.squeeze(1).tolist()
+        if scale <= 0:
+            # degenerate calibration, so fall back to the largest ratio
+            offset, scale = 0., float((y / a).max())
+        self.coef[stage] = (offset, scale)
+
+    def calibrate(self, model: 'pl.LightningModule',
+                  batches: list[HeteroData],
+                  stages: list[str] = ['train', 'inference']) -> None:
+        '''Measure peak memory over calibration batches of varying size, and
+        fit the memory model for each stage'''
+        counts = [ self.counts(batch) for batch in batches ]
+        for stage in stages:
+            peaks = [ self.measure(model, batch, stage == 'train') for batch in batches ]
+            self.fit(counts, peaks, stage)
+
+    def predict(self, counts: Counts, stage: str = 'train') -> float:
+        '''Predicted peak memory in bytes'''
+        if stage not in self.coef:
+            raise Exception(f'memory model has not been calibrated for {stage}!')
+        offset, scale = self.coef[stage]
+        return offset + scale * self.activations(counts)
@@ -0,0 +1,153 @@
+import collections
+import json
+import time
+
+import psutil
+import torch
+import torch.nn as nn
+
+class ModuleProfiler:
+    '''Record wall time and memory deltas of NuGraph submodules
+
+    Forward hooks are registered on the model and the requested submodules
+    when the profiler is attached, and removed when it is detached, so there
+    is no overhead when profiling is disabled. Each model forward pass is
+    one step, and calls to the iteration module mark the start of each
+    message-passing iteration. Submodule calls outside a model forward pass,
+    such as checkpoint recomputation during backward, are not recorded.
+
+    Memory deltas are taken from allocated device memory on GPU, or from
+    process RSS on CPU. Recording stops after max_steps steps, if set.'''
+    def __init__(self, sync: bool = True, max_steps: int = None):
+        self.sync = sync
+        self.max_steps = max_steps
+        self.handles = []
+        self.events = []
+        self.steps = []
+        self.active = False
+        self.iteration = None
+        self.stack = collections.defaultdict(list)
+        self.process = psutil.Process()
+        self.device = None
+
+    def attach(self, model: nn.Module,
+               modules: dict[str, nn.Module],
+               iteration: str = None) -> None:
+        '''Register hooks on the model and its named submodules'''
+        self.handles.append(model.register_forward_pre_hook(self.begin_step))
+        self.handles.append(model.register_forward_hook(self.end_step))
+        for name, module in modules.items():
+            self.handles.append(module.register_forward_pre_hook(
+                lambda m, args, name=name: self.begin(name, name == iteration)))
+            self.handles.append(module.register_forward_hook(
+                lambda m, args, out, name=name: self.end(name)))
+
+    def detach(self) -> None:
+        '''Remove all hooks'''
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def reset(self) -> None:
+        self.events = []
+        self.steps = []
+
+    def now(self) -> tuple[float, float]:
+        '''Synchronised timestamp and memory usage in bytes'''
+        if self.device is not None:
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            mem = torch.cuda.memory_allocated(self.device)
+        else:
+            mem = self.process.memory_info().rss
+        return time.perf_counter(), mem
+
+    def begin_step(self, model: nn.Module, args: tuple) -> None:
+        if self.max_steps is not None and len(self.steps) >= self.max_steps:
+            return
+        # model inputs are node features and batch indices keyed by plane
+        x, batch = args[0], args[-1]
+        num_nodes = sum(t.size(0) for t in x.values())
+        num_graphs = max(int(b.max()) + 1 if b.numel() else 0 for b in batch.values())
+        first = next(iter(x.values()))
+        self.device = first.device if first.is_cuda else None
+        self.steps.append({ 'graphs': num_graphs, 'nodes': num_nodes })
+        self.active = True
+        self.iteration = None
+        self.begin('model')
+
+    def end_step(self, model: nn.Module, args: tuple, out) -> None:
+        if not self.active:
+            return
+        self.end('model')
+        self.active = False
+
+    def begin(self, name: str, iteration: bool = False) -> None:
+        if not self.active:
+            return
+        if iteration:
+            self.iteration = 0 if self.iteration is None else self.iteration + 1
+        self.stack[name].append(self.now())
+
+    def end(self, name: str) -> None:
+        if not self.active or not self.stack[name]:
+            return
+        start, mem_start = self.stack[name].pop()
+        end, mem_end = self.now()
+        self.events.append({
+            'name': name,
+            'step': len(self.steps) - 1,
+            'iteration': None if name == 'model' else self.iteration,
+            'start': start,
+            'duration': end - start,
+            'memory': mem_end - mem_start,
+        })
+
+    def summary(self, per_iteration: bool = False) -> dict[str, dict[str, float]]:
+        '''Mean time in ms and memory delta in MB per step for each module,
+        with time also normalised per graph and per node in microseconds'''
+        if not self.steps:
+            return {}
+        num_steps = len(self.steps)
+        num_graphs = sum(s['graphs'] for s in self.steps)
+        num_nodes = sum(s['nodes'] for s in self.steps)
+        totals = collections.defaultdict(lambda: [0., 0.])
+        for e in self.events:
+            key = e['name']
+            if per_iteration and e['iteration'] is not None:
+                key = f'{key}/iter{e["iteration"]}'
+            totals[key][0] += e['duration']
+            totals[key][1] += e['memory']
+        return { key: {
+            'time': 1e3 * t / num_steps,
+            'time_per_graph': 1e6 * t / max(num_graphs, 1),
+            'time_per_node': 1e6 * t / max(num_nodes, 1),
+            'memory': m / num_steps / 1048576,
+        } for key, (t, m) in totals.items() }
+
+    def log(self, writer: 'torch.utils.tensorboard.SummaryWriter',
+            global_step: int = None) -> None:
+        '''Write the profile summary to TensorBoard'''
+        for key, values in self.summary(per_iteration=True).items():
+            for stat, value in values.items():
+                writer.add_scalar(f'profile_{stat}/{key}', value, global_step)
+
+    def export_chrome_trace(self, path: str) -> None:
+        '''Write recorded events as a Chrome trace, viewable in
+        chrome://tracing or Perfetto'''
+        origin = min((e['start'] for e in self.events), default=0.)
+        events = [{
+            'name': e['name'],
+            'ph': 'X',
+            'ts': 1e6 * (e['start'] - origin),
+            'dur': 1e6 * e['duration'],
+            'pid': 0,
+            'tid': 0,
+            'args': {
+                'step': e['step'],
+                'iteration': e['iteration'],
+                'memory_delta_mb': e['memory'] / 1048576,
+            },
+        } for e in self.events ]
+        with open(path, 'w') as f:
+            json.dump({ 'traceEvents': events }, f)
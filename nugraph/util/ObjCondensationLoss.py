@@ -1,44 +1,77 @@
 import torch
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 
 class ObjCondensationLoss(torch.nn.Module):
-    def __init__(self, S_b: float = 1.0, q_min: float = 0.5):
+    '''Object condensation loss, as described in https://arxiv.org/abs/2002.03605
+
+    Condensation points are found with scatter operations, and the potential
+    loss is evaluated over chunks of hits, so memory scales linearly with the
+    number of hits rather than with hits x instances.'''
+    def __init__(self, S_b: float = 1.0, q_min: float = 0.5,
+                 chunk_elements: int = 1 << 24):
         super().__init__()
         self.S_b = S_b
         self.q_min = q_min
+        self.chunk_elements = chunk_elements
+
+    def condensation_points(self, q: Tensor, y: Tensor) -> tuple[Tensor, Tensor]:
+        '''Index of the highest-charge hit in each instance, and a mask of
+        which instances contain hits'''
+        K = int(y.max()) + 1 if y.numel() else 0
+        signal = (y != -1).nonzero().squeeze(1)
+        with torch.no_grad():
+            q_max = q.new_zeros(K).scatter_reduce(0, y[signal], q[signal], 'amax')
+            is_max = signal[q[signal] == q_max[y[signal]]]
+            idx = torch.zeros(K, dtype=torch.long, device=y.device)
+            idx.scatter_(0, y[is_max], is_max)
+            present = torch.zeros(K, dtype=torch.bool, device=y.device)
+            present[y[signal]] = True
+        return idx, present
 
     def background_loss(self, beta: Tensor, y: Tensor) -> Tensor:
-        K = y.max() + 1
+        idx, present = self.condensation_points(beta, y)
+        K = idx.size(0)
         n_i = (y == -1)
-        M_ik = torch.zeros((y.size(0), K)).long()
-        M_ik[~n_i,:] = torch.nn.functional.one_hot(y[~n_i], num_classes=K)
-        beta_ak = (beta[:,None] * M_ik).max(dim=0).values
+        beta_ak = beta[idx] * present
         N_b = n_i.sum()
-        L_beta_1 = (1 - beta_ak).sum() / K
-        L_beta_2 = (self.S_b / N_b) * (n_i * beta).sum()
-        L_beta = torch.sum(L_beta_1 + L_beta_2)
-        return L_beta
-    
+        L_beta_1 = (1 - beta_ak).sum() / max(K, 1)
+        L_beta_2 = (self.S_b / N_b.clamp(min=1)) * (n_i * beta).sum()
+        return L_beta_1 + L_beta_2
+
+    def potential(self, x: Tensor, q: Tensor, y: Tensor,
+                  x_a: Tensor, q_ak: Tensor) -> Tensor:
+        '''Charge-weighted potential summed over a chunk of hits'''
+        x_diff = (x[:,None,:] - x_a[None,:,:]).square().sum(dim=2)
+        x_inv = (1 - x_diff).clamp(min=0)
+        # repulsion from every condensation point
+        V = (x_inv * q_ak).sum(dim=1)
+        # replace repulsion from a hit's own condensation point with attraction
+        member = y != -1
+        k = y.clamp(min=0)[:,None]
+        own = q_ak[k.squeeze(1)] * member
+        V = V + own * (x_diff.gather(1, k) - x_inv.gather(1, k)).squeeze(1)
+        return (V * q).sum()
+
     def potential_loss(self, x: Tensor, beta: Tensor, y: Tensor) -> Tensor:
-        K = y.max() + 1
-        n_i = (y == -1)
-        M_ik = torch.zeros((y.size(0), K)).long()
-        M_ik[~n_i,:] = torch.nn.functional.one_hot(y[~n_i], num_classes=K)
         q_i = beta.atanh().square() + self.q_min
-        q_max = (q_i[:,None] * M_ik).max(dim=0)
-        q_ak = q_max.values
-        idx_ak = q_max.indices
-        x_a = x[idx_ak]
-        x_diff = (x[:,None,:] - x_a[None,:,:]).square().sum(dim=2)
-        x_inv = 1 - x_diff
-        x_inv[(x_inv < 0)] = 0
-        V_k_a = x_diff[None,:] * q_ak
-        V_k_r = x_inv[None, :] * q_ak
-        N=y.size(0)
-        L_v_1=M_ik*(V_k_a)
-        L_v_2=(1-M_ik)*(V_k_r)
-        L_v=((L_v_1+L_v_2).sum(dim=2) * q_i).sum () / N
-        return L_v
+        idx, present = self.condensation_points(q_i, y)
+        q_ak = q_i[idx] * present
+        x_a = x[idx]
+        N = y.size(0)
+        # a batch of only background hits has no condensation points
+        if not idx.numel():
+            return x.new_zeros(())
+        step = max(1, self.chunk_elements // max(1, x_a.numel()))
+        L_v = x.new_zeros(())
+        for start in range(0, N, step):
+            args = (x[start:start+step], q_i[start:start+step],
+                    y[start:start+step], x_a, q_ak)
+            if torch.is_grad_enabled():
+                L_v = L_v + checkpoint(self.potential, *args, use_reentrant=False)
+            else:
+                L_v = L_v + self.potential(*args)
+        return L_v / N
 
     def forward(self, x: Tensor, beta: Tensor, y: Tensor) -> Tensor:
-        return self.background_loss(beta, y) + self.potential_loss(x, beta, y)
\ No newline at end of file
+        return self.background_loss(beta, y) + self.potential_loss(x, beta, y)
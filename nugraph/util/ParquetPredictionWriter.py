@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pandas as pd
+from torch_geometric.data import Batch
+
+from .PredictionWriter import PredictionWriter
+
+class ParquetPredictionWriter(PredictionWriter):
+    '''Write predictions to a Parquet file, one row group per batch
+
+    Rows are ordered by event within each batch, and a sidecar index maps
+    each (run, subrun, event) onto its row group, offset and length, so a
+    single event can be read without scanning the file. Class scores and
+    filter scores can optionally be compacted to float16, or quantised to
+    uint8 with a scale of 1/255.
+
+    A Parquet file is only readable once its footer is written on close, so
+    output is written to a temporary file that is renamed into place when
+    prediction finishes. Interrupted runs cannot be resumed.'''
+    def __init__(self,
+                 path: str,
+                 planes: list[str],
+                 semantic_classes: list[str],
+                 compact: str = None):
+        super().__init__(path, planes, semantic_classes)
+        if compact not in (None, 'float16', 'uint8'):
+            raise Exception(f'unknown score compaction "{compact}"!')
+        self.compact = compact
+        self.scores = semantic_classes + ['x_filter']
+        self.index_file = self.index_path(path)
+        self.writer = None
+        self.index = []
+        self.row_groups = 0
+
+    def resume(self) -> int:
+        raise Exception('resuming is only supported for HDF5 prediction output!')
+
+    def to_table(self, batch: Batch) -> 'pa.Table':
+        '''Arrow table for a batch, sorted by event and with compacted scores'''
+        import pyarrow as pa
+        df = self.to_dataframe(batch)
+        df = df.iloc[np.lexsort((df.event, df.subrun, df.run))]
+        for col in self.scores:
+            if col not in df:
+                continue
+            if self.compact == 'float16':
+                df[col] = df[col].astype(np.float16)
+            elif self.compact == 'uint8':
+                df[col] = np.rint(df[col].clip(0, 1) * 255).astype(np.uint8)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.compact == 'uint8':
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}), b'nugraph_score_scale': str(1/255).encode()})
+        return table
+
+    def write(self, batch: Batch, batch_idx: int) -> None:
+        '''Append predictions for one batch as a new row group'''
+        import pyarrow.parquet as pq
+        table = self.to_table(batch)
+        if self.writer is None:
+            if os.path.exists(self.path):
+                raise Exception(f'file {self.path} already exists!')
+            self.writer = pq.ParquetWriter(f'{self.path}.tmp', table.schema)
+        self.writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+        # index contiguous events within the row group
+        keys = np.stack([table[k].to_numpy() for k in ('run', 'subrun', 'event')], axis=1)
+        start = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+        length = np.diff(np.r_[start, len(keys)])
+        self.index.append(pd.DataFrame({
+            'run': keys[start,0],
+            'subrun': keys[start,1],
+            'event': keys[start,2],
+            'row_group': self.row_groups,
+            'offset': start,
+            'length': length,
+        }))
+        self.row_groups += 1
+
+    def close(self) -> None:
+        '''Write the Parquet footer and the sidecar event index'''
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        os.replace(f'{self.path}.tmp', self.path)
+        pd.concat(self.index, ignore_index=True).to_parquet(self.index_file, index=False)
+        self.index = []
+
+    @staticmethod
+    def index_path(path: str) -> str:
+        '''Path of the sidecar event index for a Parquet prediction file'''
+        return f'{os.path.splitext(path)[0]}.index.parquet'
+
+    @staticmethod
+    def read_event(path: str, run: int, subrun: int, event: int,
+                   columns: list[str] = None) -> pd.DataFrame:
+        '''Read the predictions for a single event from a Parquet prediction
+        file, using its sidecar index'''
+        import pyarrow.parquet as pq
+        index = pd.read_parquet(ParquetPredictionWriter.index_path(path))
+        row = index[(index.run == run) & (index.subrun == subrun) & (index.event == event)]
+        if row.empty:
+            raise Exception(f'event {run}:{subrun}:{event} not found in {path}!')
+        row = row.iloc[0]
+        table = pq.ParquetFile(path).read_row_group(int(row.row_group), columns=columns)
+        return table.slice(int(row.offset), int(row.length)).to_pandas()
@@ -0,0 +1,26 @@
+import threading
+import time
+
+import psutil
+
+class PeakRSS:
+    '''Sample resident memory in a background thread and record the peak'''
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.process = psutil.Process()
+
+    def __enter__(self) -> 'PeakRSS':
+        self.base = self.peak = self.process.memory_info().rss
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.running = False
+        self.thread.join()
+
+    def sample(self) -> None:
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+from pytorch_lightning import LightningModule, Trainer
+from pytorch_lightning.callbacks import BasePredictionWriter
+from torch_geometric.data import Batch
+
+from .hits import hit_table
+
+class PredictionWriter(BasePredictionWriter):
+    '''Append predictions to an HDF5 table as each batch completes
+
+    Only one batch of predictions is held in memory at a time. Every row is
+    tagged with the index of the batch it came from, and the numbers of
+    complete batches and graphs are stored alongside the table. An
+    interrupted run can therefore be resumed: resume() drops any rows from a
+    partially written batch and returns the graph to restart from, so the
+    batch size may differ between runs.'''
+    def __init__(self,
+                 path: str,
+                 planes: list[str],
+                 semantic_classes: list[str],
+                 key: str = 'hits'):
+        super().__init__(write_interval='batch')
+        self.path = path
+        self.key = key
+        self.planes = planes
+        self.semantic_classes = semantic_classes
+        self.offset = 0
+        self.graphs = 0
+
+    def resume(self) -> int:
+        '''Number of graphs already written, after removing any rows from an
+        incomplete batch'''
+        if not os.path.isfile(self.path):
+            return 0
+        with pd.HDFStore(self.path) as store:
+            if 'progress' not in store or len(store['progress']) != 2:
+                raise Exception(f'file {self.path} exists, but has no prediction progress to resume from!')
+            batches, graphs = (int(n) for n in store['progress'])
+            if self.key in store:
+                store.remove(self.key, where=f'batch >= {batches}')
+        self.offset = batches
+        self.graphs = graphs
+        return graphs
+
+    def to_dataframe(self, batch: Batch) -> pd.DataFrame:
+        '''Hit table for a batch, with plane and class codes as categories'''
+        df = pd.DataFrame(hit_table(batch, self.planes, self.semantic_classes))
+        df['plane'] = pd.Categorical.from_codes(df.plane, categories=self.planes)
+        labels = ['background'] + self.semantic_classes
+        for key in ('y_semantic', 'x_semantic'):
+            if key in df:
+                df[key] = pd.Categorical.from_codes(df[key] + 1, categories=labels)
+        return df
+
+    def write(self, batch: Batch, batch_idx: int) -> None:
+        '''Append predictions for one batch, and record it as complete'''
+        idx = self.offset + batch_idx
+        df = self.to_dataframe(batch)
+        df['batch'] = idx
+        self.graphs += batch.num_graphs
+        with pd.HDFStore(self.path) as store:
+            store.append(self.key, df, format='table', data_columns=['batch'], index=False)
+            store.put('progress', pd.Series([idx + 1, self.graphs]))
+
+    def close(self) -> None:
+        '''Finish writing the output file'''
+        return
+
+    def write_on_batch_end(self,
+                           trainer: Trainer,
+                           pl_module: LightningModule,
+                           prediction: Batch,
+                           batch_indices: list[int],
+                           batch: Batch,
+                           batch_idx: int,
+                           dataloader_idx: int = 0) -> None:
+        self.write(prediction, batch_idx)
+
+    def on_predict_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        self.close()
@@ -3,7 +3,6 @@
 import torch
 from torch import Tensor
 import torch.nn.functional as F
-from torchmetrics.functional import recall
 
 class RecallLoss(torch.nn.Module):
     def __init__(self, ignore_index: int = -1):
@@ -11,11 +10,17 @@ class RecallLoss(torch.nn.Module):
         self.ignore_index = ignore_index
 
     def forward(self, input: Tensor, target: Tensor) -> Tensor:
-        weight = 1 - recall(input, target, 'multiclass',
-                            num_classes=input.size(1),
-                            average='none',
-                            ignore_index=self.ignore_index)
-        ce = F.cross_entropy(input, target, reduction='none',
-                             ignore_index=self.ignore_index)
-        loss = weight[target] * ce
-        return loss.mean()
\ No newline at end of file
+        num_classes = input.size(1)
+        mask = target != self.ignore_index
+        x, y = input[mask], target[mask]
+
+        # per-class support and true positives from a single bincount
+        correct = (x.detach().argmax(dim=1) == y).long()
+        counts = torch.bincount(2 * y + correct, minlength=2*num_classes)
+        counts = counts.view(num_classes, 2)
+        recall = counts[:, 1] / counts.sum(dim=1).clamp(min=1)
+        weight = 1 - recall
+
+        # cross entropy from the log-softmax, averaged over all nodes
+        ce = -F.log_softmax(x, dim=1).gather(1, y[:, None]).squeeze(1)
+        return (weight[y] * ce).sum() / target.size(0)
@@ -0,0 +1,114 @@
+import collections
+import threading
+import time
+
+import numpy as np
+import psutil
+import torch
+from pytorch_lightning import Callback, LightningModule, Trainer
+
+class Telemetry(Callback):
+    '''Sample resource usage on a background thread, and log summaries
+
+    CPU RSS and device memory are sampled every interval seconds by a
+    background thread. Dataloader wait and step times are timestamped at
+    batch boundaries, with no resource queries on the training loop. Every
+    summary_interval seconds, and at the end of each stage, the thread logs
+    the max, median and 99th percentile of each quantity.'''
+    def __init__(self, interval: float = 1., summary_interval: float = 60.):
+        super().__init__()
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self.samples = collections.deque()
+        self.thread = None
+        self.stop = threading.Event()
+        self.last_end = None
+        self.step_start = None
+
+    def start(self, trainer: Trainer, pl_module: LightningModule, stage: str) -> None:
+        self.samples.clear()
+        self.last_end = None
+        self.stop.clear()
+        device = pl_module.device if pl_module.device.type == 'cuda' else None
+        self.thread = threading.Thread(target=self.run,
+                                       args=(trainer, stage, device),
+                                       name='telemetry', daemon=True)
+        self.thread.start()
+
+    def finish(self) -> None:
+        if self.thread is None:
+            return
+        self.stop.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self, trainer: Trainer, stage: str, device: torch.device) -> None:
+        process = psutil.Process()
+        last_summary = time.perf_counter()
+        while True:
+            stopped = self.stop.wait(self.interval)
+            self.samples.append(('memory_cpu', process.memory_info().rss / 1073741824))
+            if device is not None:
+                self.samples.append(('memory_gpu', torch.cuda.memory_reserved(device) / 1073741824))
+            now = time.perf_counter()
+            if stopped or now - last_summary >= self.summary_interval:
+                self.summarise(trainer, stage)
+                last_summary = now
+            if stopped:
+                return
+
+    def summarise(self, trainer: Trainer, stage: str) -> None:
+        '''Log summary statistics of samples since the last summary'''
+        values = collections.defaultdict(list)
+        while self.samples:
+            key, value = self.samples.popleft()
+            values[key].append(value)
+        metrics = {}
+        for key, v in values.items():
+            v = np.asarray(v)
+            metrics[f'{key}_max/{stage}'] = float(v.max())
+            metrics[f'{key}_p50/{stage}'] = float(np.percentile(v, 50))
+            metrics[f'{key}_p99/{stage}'] = float(np.percentile(v, 99))
+        if metrics and trainer.logger:
+            trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+    def batch_start(self) -> None:
+        now = time.perf_counter()
+        if self.last_end is not None:
+            self.samples.append(('dataloader_wait', now - self.last_end))
+        self.step_start = now
+
+    def batch_end(self) -> None:
+        now = time.perf_counter()
+        self.samples.append(('step_time', now - self.step_start))
+        self.last_end = now
+
+    def on_train_start(self, trainer, pl_module):
+        self.start(trainer, pl_module, 'train')
+
+    def on_train_end(self, trainer, pl_module):
+        self.finish()
+
+    def on_test_start(self, trainer, pl_module):
+        self.start(trainer, pl_module, 'test')
+
+    def on_test_end(self, trainer, pl_module):
+        self.finish()
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.last_end = None
+
+    def on_validation_start(self, trainer, pl_module):
+        self.last_end = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx):
+        self.batch_start()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx):
+        self.batch_end()
+
+    def on_test_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        self.batch_start()
+
+    def on_test_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        self.batch_end()
@@ -0,0 +1,173 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import time
+
+import torch
+from torch.utils.data import Dataset
+from torch_geometric.loader import DataLoader
+
+def available_cores() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def step_time(model: 'pl.LightningModule', batches: list,
+              train: bool, repeats: int) -> float:
+    '''Mean time in seconds of a model step over the sample batches'''
+    model.train(train)
+    times = []
+    with torch.set_grad_enabled(train):
+        for it in range(repeats + 1):
+            start = time.perf_counter()
+            for batch in batches:
+                loss, _ = model.step(batch.clone())
+                if train:
+                    loss.backward()
+                    model.zero_grad()
+            # the first pass is warm-up
+            if it:
+                times.append(time.perf_counter() - start)
+    return sum(times) / (repeats * len(batches))
+
+def sweep(model: 'pl.LightningModule', batches: list, train: bool,
+          repeats: int, inter: int, intra: list[int]) -> dict[int, float]:
+    '''Step time for each intra-op thread count at a fixed inter-op thread
+    count. The inter-op thread pool can only be sized before it is first
+    used, so this runs in a freshly spawned process.'''
+    torch.set_num_interop_threads(inter)
+    ret = {}
+    for n in intra:
+        torch.set_num_threads(n)
+        ret[n] = step_time(model, batches, train, repeats)
+    return ret
+
+class ThreadTuner:
+    '''Select CPU thread counts by measuring model step time
+
+    Intra-op and inter-op thread counts are swept on a sample of real
+    batches, and the fastest configuration for each stage is saved to a
+    JSON file keyed by host name and number of available cores, so later
+    runs on the same machine can apply it at startup without re-measuring.
+    Cores can be held in reserve for other processes, such as data loader
+    workers.
+
+    OpenMP thread binding is swept too. OpenMP reads OMP_PROC_BIND and
+    OMP_PLACES once, when torch is loaded, so each binding is measured in a
+    process spawned with it in its environment, and a tuned binding can
+    only be applied by setting those variables before the next run.'''
+    def __init__(self, path: str = None, reserve: int = 0):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache',
+                                'nugraph', 'threads.json')
+        self.path = path
+        self.cores = max(available_cores() - reserve, 1)
+        self.key = f'{platform.node()}/{available_cores()}cores/{reserve}reserved'
+
+    def candidates(self) -> tuple[list[int], list[int], list[dict[str, str]]]:
+        '''Intra-op and inter-op thread counts, and OpenMP thread bindings,
+        to measure. The first binding leaves the environment unchanged.'''
+        intra = sorted({ 2**i for i in range(self.cores.bit_length()) } | { self.cores })
+        inter = sorted({ 1, 2, min(4, self.cores) })
+        binding = [{},
+                   { 'OMP_PROC_BIND': 'close', 'OMP_PLACES': 'cores' },
+                   { 'OMP_PROC_BIND': 'spread', 'OMP_PLACES': 'cores' }]
+        return intra, inter, binding
+
+    def load(self) -> dict:
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def saved(self, stage: str = 'inference') -> dict:
+        '''Saved settings for this machine and stage, if any'''
+        return self.load().get(self.key, {}).get(stage)
+
+    def save(self, settings: dict) -> None:
+        configs = self.load()
+        configs.setdefault(self.key, {})[settings['stage']] = settings
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(configs, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def apply(self, settings: dict = None, stage: str = 'inference') -> bool:
+        '''Apply the given or saved settings, returning False if none exist'''
+        settings = settings or self.saved(stage)
+        if not settings:
+            return False
+        torch.set_num_threads(settings['intra_op_threads'])
+        try:
+            torch.set_num_interop_threads(settings['inter_op_threads'])
+        except RuntimeError:
+            print('inter-op thread pool is already running, so its size will take effect on the next run')
+        binding = settings.get('binding', {})
+        if any(os.environ.get(k) != v for k, v in binding.items()):
+            env = ' '.join(f'{k}={v}' for k, v in binding.items())
+            print(f'OpenMP thread binding is fixed at startup, so set {env} in the environment to apply it')
+        return True
+
+    def tune(self, model: 'pl.LightningModule', dataset: Dataset,
+             batch_size: int, num_batches: int = 4, repeats: int = 3,
+             train: bool = False) -> dict:
+        '''Measure step time across thread configurations on a sample of
+        batches from the dataset, then save and apply the fastest'''
+        loader = DataLoader(dataset, batch_size=batch_size)
+        batches = list(itertools.islice(loader, num_batches))
+        model = model.cpu()
+        intra, inter, binding = self.candidates()
+        ctx = multiprocessing.get_context('spawn')
+        times = {}
+        for b, env in enumerate(binding):
+            # spawned processes take a copy of the environment at startup
+            saved = { k: os.environ.get(k) for k in env }
+            os.environ.update(env)
+            try:
+                for n in inter:
+                    with ctx.Pool(1) as pool:
+                        res = pool.apply(sweep, (model, batches, train, repeats, n, intra))
+                    for m, t in res.items():
+                        times[(m, n, b)] = t
+                        print(f'{m:>4} intra-op, {n:>2} inter-op threads, '
+                              f'{env.get("OMP_PROC_BIND", "default")} binding: {1e3*t:.1f} ms/step')
+            finally:
+                for k, v in saved.items():
+                    if v is None:
+                        os.environ.pop(k)
+                    else:
+                        os.environ[k] = v
+        (m, n, b), t = min(times.items(), key=lambda kv: kv[1])
+        settings = {
+            'intra_op_threads': m,
+            'inter_op_threads': n,
+            'binding': binding[b],
+            'step_time': t,
+            'stage': 'train' if train else 'inference',
+            'batch_size': batch_size,
+        }
+        print(f'selected {m} intra-op and {n} inter-op threads, '
+              f'with {binding[b].get("OMP_PROC_BIND", "default")} binding')
+        self.save(settings)
+        self.apply(settings)
+        return settings
+
+    @staticmethod
+    def add_args(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+        '''Add argparse arguments for CPU thread tuning'''
+        threads = parser.add_argument_group('threads', 'CPU thread configuration')
+        threads.add_argument('--thread-config', type=str, default=None,
+                             help='File to save and load tuned thread settings, by default ~/.cache/nugraph/threads.json')
+        threads.add_argument('--tune-threads', action='store_true', default=False,
+                             help='Measure step time to select CPU thread counts for this machine')
+        threads.add_argument('--thread-reserve', type=int, default=0,
+                             help='Number of cores to leave free for other processes')
+        return parser
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> 'ThreadTuner':
+        return cls(args.thread_config, args.thread_reserve)
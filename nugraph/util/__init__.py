@@ -4,4 +4,16 @@ from .LogCoshLoss import LogCoshLoss
 from .ObjCondensationLoss import ObjCondensationLoss
 from .PositionFeatures import PositionFeatures
 from .FeatureNorm import FeatureNorm, FeatureNormMetric
+from .CheckpointPolicy import CheckpointPolicy
+from .clustering import radius_pairs, condensation_clustering
+from .Telemetry import Telemetry
+from .CpuAffinity import CpuAffinity
+from .ThreadTuner import ThreadTuner
+from .ModuleProfiler import ModuleProfiler
+from .PeakRSS import PeakRSS
+from .MemoryModel import MemoryModel
+from .hits import hit_table
+from .PredictionWriter import PredictionWriter
+from .ParquetPredictionWriter import ParquetPredictionWriter
+from .figures import log_figure, flush_figures
 from .scriptutils import configure_device
\ No newline at end of file
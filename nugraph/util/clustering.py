@@ -0,0 +1,108 @@
+import itertools
+import math
+import torch
+from torch import Tensor
+
+def grid_keys(cells: Tensor, batch: Tensor, extent: Tensor) -> Tensor:
+    '''Flatten integer grid cells, and the graph they belong to, into a
+    single key per point'''
+    stride = torch.cat((extent.flip(0).cumprod(0).flip(0), extent.new_ones(1)))
+    return batch * stride[0] + (cells * stride[1:]).sum(dim=-1)
+
+def radius_pairs(query: Tensor, query_batch: Tensor,
+                 ref: Tensor, ref_batch: Tensor,
+                 radius: float) -> tuple[Tensor, Tensor]:
+    '''All pairs of query and reference points in the same graph that lie
+    within a radius of one another
+
+    Points are hashed onto a grid with a cell size equal to the radius, so
+    each query point only needs to be compared against reference points in
+    its own and neighbouring cells. For bounded point density, the cost is
+    linear in the number of points, although the number of neighbouring
+    cells grows as 3^D with the dimension of the space.'''
+    if query.size(0) == 0 or ref.size(0) == 0:
+        empty = torch.empty(0, dtype=torch.long, device=query.device)
+        return empty, empty
+    lo = torch.minimum(query.min(dim=0).values, ref.min(dim=0).values)
+    cq = ((query - lo) / radius).floor().long() + 1
+    cr = ((ref - lo) / radius).floor().long() + 1
+    extent = torch.maximum(cq.max(dim=0).values, cr.max(dim=0).values) + 2
+    num_graphs = max(int(query_batch.max()), int(ref_batch.max())) + 1
+    if sum(math.log2(e) for e in extent.tolist()) + math.log2(num_graphs) > 62:
+        raise Exception('clustering space is too large to hash onto a grid!')
+
+    # sort reference points by key, and look up each neighbouring cell
+    ref_keys, order = grid_keys(cr, ref_batch, extent).sort()
+    offsets = torch.tensor(list(itertools.product((-1, 0, 1), repeat=query.size(1))),
+                           device=query.device)
+    keys = grid_keys(cq[:,None,:] + offsets[None,:,:], query_batch[:,None], extent)
+    start = torch.searchsorted(ref_keys, keys.flatten())
+    count = torch.searchsorted(ref_keys, keys.flatten(), right=True) - start
+
+    # expand matching ranges into candidate pairs
+    total = int(count.sum())
+    first = count.cumsum(0) - count
+    i = torch.arange(keys.size(0), device=query.device).repeat_interleave(
+        offsets.size(0)).repeat_interleave(count, output_size=total)
+    pos = torch.arange(total, device=query.device) \
+        - first.repeat_interleave(count, output_size=total) \
+        + start.repeat_interleave(count, output_size=total)
+    j = order[pos]
+
+    keep = (query[i] - ref[j]).square().sum(dim=1) <= radius * radius
+    return i[keep], j[keep]
+
+@torch.no_grad()
+def condensation_clustering(coords: Tensor,
+                            beta: Tensor,
+                            batch: Tensor,
+                            radius: float = 0.5,
+                            threshold: float = 0.1) -> Tensor:
+    '''Cluster hits into instances around condensation points
+
+    Hits with beta above threshold are condensation point candidates, which
+    are accepted greedily in order of descending beta: a candidate becomes a
+    condensation point unless an accepted condensation point with higher
+    beta lies within the radius. Every hit is then assigned to the
+    highest-beta condensation point within the radius, or labelled -1 if
+    there is none, so every candidate is assigned to an instance. Instance
+    ids are numbered from zero within each graph.'''
+    cand = (beta > threshold).nonzero().squeeze(1)
+    b = beta[cand]
+    i, j = radius_pairs(coords[cand], batch[cand], coords[cand], batch[cand], radius)
+    higher = (b[j] > b[i]) | ((b[j] == b[i]) & (j < i))
+    i, j = i[higher], j[higher]
+
+    # resolve the greedy ordering in parallel rounds: a candidate is
+    # rejected once a higher neighbour is accepted, and accepted once every
+    # higher neighbour is rejected, so each round settles at least the
+    # highest unresolved candidate in each neighbourhood
+    UNRESOLVED, ACCEPTED, REJECTED = 0, 1, 2
+    state = torch.full_like(cand, UNRESOLVED)
+    while (state == UNRESOLVED).any():
+        blocked = torch.zeros_like(state, dtype=torch.bool)
+        blocked[i[state[j] != REJECTED]] = True
+        killed = torch.zeros_like(blocked)
+        killed[i[state[j] == ACCEPTED]] = True
+        unresolved = state == UNRESOLVED
+        state[unresolved & killed] = REJECTED
+        state[unresolved & ~blocked] = ACCEPTED
+    cp = cand[state == ACCEPTED]
+    cp = cp[batch[cp].sort(stable=True).indices]
+
+    # assign hits to the highest-beta condensation point in range
+    i, j = radius_pairs(coords, batch, coords[cp], batch[cp], radius)
+    score = beta[cp][j]
+    best = torch.full_like(beta, -1.).scatter_reduce(0, i, score, 'amax')
+    win = score == best[i]
+    instance = torch.full_like(batch, -1)
+    instance[i[win]] = j[win]
+
+    # renumber condensation points within each graph
+    num_graphs = int(batch.max()) + 1 if batch.numel() else 0
+    counts = torch.bincount(batch[cp], minlength=num_graphs)
+    first = counts.cumsum(0) - counts
+    local = torch.arange(cp.size(0), device=beta.device) - first[batch[cp]]
+    assigned = instance != -1
+    instance[assigned] = local[instance[assigned]]
+    return instance
@@ -0,0 +1,37 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from matplotlib.figure import Figure
+
+_executor = None
+_pending = []
+
+def log_figure(logger: 'pl.loggers.TensorBoardLogger',
+               tag: str,
+               draw: Callable[..., Figure],
+               *args,
+               global_step: int = None) -> Future:
+    '''Draw a figure and add it to the logger on a background thread
+
+    Figures are rendered one at a time on a single worker thread, in the
+    order they were submitted. Drawing functions should build figures with
+    the object-oriented matplotlib API rather than pyplot, which is not
+    thread-safe; figures are closed once they have been logged.'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='figures')
+    future = _executor.submit(_log_figure, logger, tag, draw, args, global_step)
+    _pending[:] = [ f for f in _pending if not f.done() ] + [ future ]
+    return future
+
+def _log_figure(logger, tag, draw, args, global_step) -> None:
+    fig = draw(*args)
+    try:
+        logger.experiment.add_figure(tag, fig, global_step=global_step, close=False)
+    finally:
+        fig.clear()
+
+def flush_figures() -> None:
+    '''Wait for all submitted figures to be logged, raising any errors'''
+    while _pending:
+        _pending.pop(0).result()
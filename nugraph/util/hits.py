@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+from torch_geometric.data import Batch, HeteroData
+
+def hit_table(data: HeteroData | Batch,
+              planes: list[str],
+              semantic_classes: list[str]) -> dict[str, np.ndarray]:
+    '''Flatten the hits of a graph or batch of graphs into columnar arrays
+
+    Each row is one hit. Event metadata is broadcast onto hits by indexing
+    with the node batch vector, and the hit index within its plane is the
+    node index less the plane's batch offset, so the whole batch is
+    converted with a handful of tensor operations per plane. Plane and
+    label columns are integer codes, with -1 marking background hits in
+    y_semantic; callers can map them onto planes and semantic_classes.
+    Prediction and truth columns are only included if present on every
+    plane.'''
+    md = data['metadata']
+    batched = isinstance(data, Batch)
+    cols = {}
+
+    def add(key: str, t: torch.Tensor) -> None:
+        cols.setdefault(key, []).append(t.detach())
+
+    for i, p in enumerate(planes):
+        store = data[p]
+        n = store.num_nodes
+        device = store.x.device
+        if batched:
+            graph, ptr = store.batch, store.ptr
+        else:
+            graph = torch.zeros(n, dtype=torch.long, device=device)
+            ptr = torch.zeros(1, dtype=torch.long, device=device)
+        for key in ('run', 'subrun', 'event'):
+            add(key, md[key].to(device).reshape(-1)[graph])
+        add('plane', torch.full((n,), i, dtype=torch.uint8, device=device))
+        add('hit', torch.arange(n, device=device) - ptr[graph])
+        if 'id' in store:
+            add('id', store.id)
+        if 'pos' in store:
+            add('wire', store.pos[:,0])
+            add('time', store.pos[:,1])
+        if 'y_semantic' in store:
+            add('y_semantic', store.y_semantic)
+            add('y_filter', store.y_semantic != -1)
+        if 'y_instance' in store:
+            add('y_instance', store.y_instance)
+        if 'x_semantic' in store:
+            x = store.x_semantic.float()
+            add('x_semantic', x.argmax(dim=-1))
+            for c, v in zip(semantic_classes, x.unbind(dim=-1)):
+                add(c, v)
+        if 'x_filter' in store:
+            add('x_filter', store.x_filter.float().reshape(-1))
+        if 'i_instance' in store:
+            add('x_instance', store.i_instance)
+
+    return { key: torch.cat(v).cpu().numpy() for key, v in cols.items()
+             if len(v) == len(planes) }
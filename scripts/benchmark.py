@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+import os
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from matplotlib.figure import Figure
+from torch_geometric.loader import DataLoader
+import nugraph as ng
+
+Data = ng.data.H5DataModule
+Models = {
+    'nugraph2': ng.models.NuGraph2,
+    'nugraph3': ng.models.NuGraph3,
+}
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Checkpoint file for trained model')
+    parser.add_argument('--model', type=str, default='nugraph3',
+                        choices=list(Models),
+                        help='Model architecture of the checkpoint')
+    parser.add_argument('--backend', type=str, nargs='+', default=['torch'],
+                        choices=['torch', 'onnx'],
+                        help='Inference backends to benchmark')
+    parser.add_argument('--onnx-model', type=str, default=None,
+                        help='ONNX model file for onnx backend')
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+                        help='Numbers of graphs per batch to benchmark')
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[torch.get_num_threads()],
+                        help='Numbers of intra-op CPU threads to benchmark')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='Number of untimed batches per configuration')
+    parser.add_argument('--num-batches', type=int, default=50,
+                        help='Number of timed batches per configuration')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to benchmark the torch backend on')
+    parser.add_argument('--outfile', type=str, default='benchmark.json',
+                        help='Output JSON file for benchmark results')
+    parser.add_argument('--plots', type=str, default=None,
+                        help='Directory to write plots of the benchmark results to')
+    parser.add_argument('--from-json', action='store_true', default=False,
+                        help='Only draw plots from an existing results file')
+    parser = Data.add_data_args(parser)
+    return parser.parse_args()
+
+def cycle(loader: DataLoader):
+    '''Iterate over a dataloader indefinitely'''
+    while True:
+        yield from loader
+
+def run(predict, loader: DataLoader, device: torch.device,
+        warmup: int, num_batches: int) -> dict[str, float]:
+    '''Time data loading and inference separately for each batch'''
+    cuda = device.type == 'cuda'
+    def sync():
+        if cuda:
+            torch.cuda.synchronize(device)
+    it = cycle(loader)
+    for _ in range(warmup):
+        predict(next(it).to(device))
+    sync()
+    if cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+    data_time, model_time, ngraphs = [], [], 0
+    with ng.util.PeakRSS() as rss:
+        for _ in range(num_batches):
+            t0 = time.perf_counter()
+            batch = next(it).to(device)
+            sync()
+            t1 = time.perf_counter()
+            predict(batch)
+            sync()
+            t2 = time.perf_counter()
+            data_time.append(t1 - t0)
+            model_time.append(t2 - t1)
+            ngraphs += batch.num_graphs
+    latency = 1000 * np.asarray(model_time)
+    total = sum(data_time) + sum(model_time)
+    ret = {
+        'graphs': ngraphs,
+        'throughput': ngraphs / total,
+        'latency_p50': float(np.percentile(latency, 50)),
+        'latency_p95': float(np.percentile(latency, 95)),
+        'latency_p99': float(np.percentile(latency, 99)),
+        'data_time': sum(data_time),
+        'model_time': sum(model_time),
+        'data_fraction': sum(data_time) / total,
+        'peak_rss': rss.peak / 1073741824,
+    }
+    if cuda:
+        ret['peak_device_memory'] = torch.cuda.max_memory_allocated(device) / 1073741824
+    return ret
+
+def benchmark(args) -> dict:
+
+    print('data path =',args.data_path)
+    nudata = Data(args.data_path, batch_size=args.batch_size, cache=args.cache)
+
+    print('using checkpoint =',args.checkpoint)
+    model = Models[args.model].load_from_checkpoint(args.checkpoint, map_location='cpu')
+    model.freeze()
+
+    results = []
+    for backend in args.backend:
+        if backend == 'onnx':
+            if args.onnx_model is None:
+                raise Exception('the --onnx-model argument is required for the onnx backend')
+            device = torch.device('cpu')
+            model = model.cpu()
+        else:
+            device = torch.device(args.device)
+            model = model.to(device)
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            if backend == 'onnx':
+                predict = ng.models.OnnxModel(args.onnx_model, model, threads).predict_step
+            else:
+                predict = model.predict_step
+            for batch_size in args.batch_sizes:
+                loader = DataLoader(nudata.test_dataset, batch_size=batch_size)
+                with torch.inference_mode():
+                    res = run(predict, loader, device, args.warmup, args.num_batches)
+                res = { 'backend': backend, 'threads': threads,
+                        'batch_size': batch_size, **res }
+                print(f'{backend:>6}{threads:>4} threads{batch_size:>5} graphs/batch: '
+                      f'{res["throughput"]:10.2f} graphs/s, '
+                      f'p50/p95/p99 {res["latency_p50"]:.1f}/{res["latency_p95"]:.1f}/{res["latency_p99"]:.1f} ms, '
+                      f'data {100*res["data_fraction"]:.1f}%, '
+                      f'peak RSS {res["peak_rss"]:.2f} GB')
+                results.append(res)
+
+    return {
+        'checkpoint': args.checkpoint,
+        'model': args.model,
+        'device': args.device,
+        'warmup': args.warmup,
+        'num_batches': args.num_batches,
+        'results': results,
+    }
+
+def plot(bench: dict, outdir: str) -> None:
+    '''Draw throughput, latency and data-loading plots from benchmark results'''
+    os.makedirs(outdir, exist_ok=True)
+    series = {}
+    for res in bench['results']:
+        series.setdefault((res['backend'], res['threads']), []).append(res)
+
+    def draw(name: str, ylabel: str, fn) -> None:
+        fig = Figure(figsize=[8,6])
+        ax = fig.add_subplot()
+        for (backend, threads), rows in series.items():
+            rows = sorted(rows, key=lambda r: r['batch_size'])
+            fn(ax, [ r['batch_size'] for r in rows ], rows,
+               f'{backend}, {threads} threads')
+        ax.set_xscale('log', base=2)
+        ax.set_xlabel('Batch size')
+        ax.set_ylabel(ylabel)
+        ax.legend()
+        fig.tight_layout()
+        fig.savefig(f'{outdir}/{name}.png')
+        fig.savefig(f'{outdir}/{name}.pdf')
+
+    def throughput(ax, x, rows, label):
+        ax.plot(x, [ r['throughput'] for r in rows ], marker='o', label=label)
+
+    def latency(ax, x, rows, label):
+        p50 = [ r['latency_p50'] for r in rows ]
+        line, = ax.plot(x, p50, marker='o', label=label)
+        ax.fill_between(x, p50, [ r['latency_p99'] for r in rows ],
+                        color=line.get_color(), alpha=0.2)
+        ax.plot(x, [ r['latency_p95'] for r in rows ],
+                color=line.get_color(), linestyle='--')
+
+    def data_fraction(ax, x, rows, label):
+        ax.plot(x, [ 100 * r['data_fraction'] for r in rows ], marker='o', label=label)
+
+    draw('throughput', 'Throughput [graphs/s]', throughput)
+    draw('latency', 'Batch latency p50 (p95 dashed, p99 band) [ms]', latency)
+    draw('data-fraction', 'Time spent loading data [%]', data_fraction)
+
+if __name__ == '__main__':
+    args = configure()
+    if args.from_json:
+        with open(args.outfile) as f:
+            bench = json.load(f)
+    else:
+        if args.checkpoint is None:
+            raise Exception('the --checkpoint argument is required to run the benchmark')
+        bench = benchmark(args)
+        with open(args.outfile, 'w') as f:
+            json.dump(bench, f, indent=2)
+        print('results written to',args.outfile)
+    if args.plots:
+        plot(bench, args.plots)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import time
+import argparse
+import torch
+from nugraph.util import ObjCondensationLoss
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, nargs='+',
+                        default=[10, 100, 1000, 5000],
+                        help='Numbers of instances to benchmark')
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[1000, 10000, 50000],
+                        help='Numbers of hits to benchmark')
+    parser.add_argument('--features', type=int, default=8,
+                        help='Dimension of the clustering space')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='Number of timed repeats per configuration')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to benchmark on')
+    parser.add_argument('--max-dense-elements', type=int, default=1 << 28,
+                        help='Skip the dense reference above this many hit x instance x feature elements')
+    return parser.parse_args()
+
+def reference(x: torch.Tensor, beta: torch.Tensor, y: torch.Tensor,
+              S_b: float = 1.0, q_min: float = 0.5) -> torch.Tensor:
+    '''Original dense object condensation loss'''
+    K = y.max() + 1
+    n_i = y == -1
+    M_ik = torch.zeros(y.size(0), K, dtype=torch.long, device=y.device)
+    M_ik[~n_i, y[~n_i]] = 1
+    beta_ak = (beta[:,None] * M_ik).max(dim=0).values
+    L_beta = (1 - beta_ak).sum() / K + (S_b / n_i.sum()) * (n_i * beta).sum()
+    q_i = beta.atanh().square() + q_min
+    q_ak, idx_ak = (q_i[:,None] * M_ik).max(dim=0)
+    x_diff = (x[:,None,:] - x[idx_ak][None,:,:]).square().sum(dim=2)
+    x_inv = (1 - x_diff).clamp(min=0)
+    V = M_ik * x_diff * q_ak + (1 - M_ik) * x_inv * q_ak
+    L_v = (V.sum(dim=1) * q_i).sum() / y.size(0)
+    return L_beta + L_v
+
+def timeit(fn, x: torch.Tensor, beta: torch.Tensor, y: torch.Tensor,
+           repeats: int) -> tuple[float, float]:
+    '''Mean forward and backward time in milliseconds, and peak device
+    memory in MB where available'''
+    fn(x, beta, y).backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        fn(x, beta, y).backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    elapsed = 1000 * (time.time() - start) / repeats
+    mem = torch.cuda.max_memory_allocated() / 1024**2 if x.is_cuda else float('nan')
+    return elapsed, mem
+
+def benchmark(args):
+    sparse = ObjCondensationLoss()
+    print(f'{"instances":>10}{"hits":>10}{"dense [ms]":>12}{"sparse [ms]":>13}'
+          f'{"dense [MB]":>12}{"sparse [MB]":>13}{"max diff":>12}')
+    for k in args.instances:
+        for n in args.nodes:
+            if k > n:
+                continue
+            x = torch.randn(n, args.features, device=args.device, requires_grad=True)
+            beta = torch.rand(n, device=args.device).mul(0.98).add(0.01).requires_grad_()
+            y = torch.randint(-1, k, (n,), device=args.device)
+            y[:k] = torch.arange(k, device=args.device)
+            t_sparse, m_sparse = timeit(sparse, x, beta, y, args.repeats)
+            if n * k * args.features <= args.max_dense_elements:
+                diff = (sparse(x, beta, y) - reference(x, beta, y)).abs().item()
+                t_dense, m_dense = timeit(reference, x, beta, y, args.repeats)
+            else:
+                diff = t_dense = m_dense = float('nan')
+            print(f'{k:>10}{n:>10}{t_dense:>12.2f}{t_sparse:>13.2f}'
+                  f'{m_dense:>12.1f}{m_sparse:>13.1f}{diff:>12.2e}')
+
+if __name__ == '__main__':
+    args = configure()
+    benchmark(args)
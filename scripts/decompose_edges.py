@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import argparse
+import torch
+import torch.nn as nn
+from nugraph.models.nugraph2 import plane as plane2, nexus as nexus2
+from nugraph.models.nugraph3 import plane as plane3, nexus as nexus3
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=500,
+                        help='Number of planar nodes')
+    parser.add_argument('--edges', type=int, default=3000,
+                        help='Number of planar and nexus edges')
+    parser.add_argument('--sp', type=int, default=200,
+                        help='Number of space points')
+    parser.add_argument('--in-feats', type=int, default=4,
+                        help='Number of input node features')
+    parser.add_argument('--planar-feats', type=int, default=16,
+                        help='Hidden dimensionality of planar convolutions')
+    parser.add_argument('--nexus-feats', type=int, default=8,
+                        help='Hidden dimensionality of nexus convolutions')
+    parser.add_argument('--classes', type=int, default=5,
+                        help='Number of semantic classes, for NuGraph2')
+    parser.add_argument('--atol', type=float, default=1e-9,
+                        help='Maximum absolute difference allowed, in float64')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed')
+    return parser.parse_args()
+
+def compare(name: str, ref: nn.Module, dec: nn.Module,
+            inputs: list[torch.Tensor], atol: float) -> None:
+    '''Check outputs, input gradients and parameter gradients of a
+    decomposed module against the original with the same weights'''
+    dec.load_state_dict(ref.state_dict())
+    results = []
+    for module in (ref, dec):
+        args = [ t.detach().clone().requires_grad_(t.is_floating_point()) for t in inputs ]
+        out = module(*args)
+        out.backward(torch.ones_like(out).cumsum(0).sin())
+        grads = [ a.grad for a in args if a.grad is not None ]
+        params = { k: p.grad for k, p in module.named_parameters() }
+        results.append((out, grads, params))
+    (out_r, grads_r, params_r), (out_d, grads_d, params_d) = results
+    diffs = { 'output': (out_r - out_d).abs().max().item() }
+    for i, (a, b) in enumerate(zip(grads_r, grads_d)):
+        diffs[f'input {i} grad'] = (a - b).abs().max().item()
+    for k in params_r:
+        diffs[f'{k} grad'] = (params_r[k] - params_d[k]).abs().max().item()
+    worst = max(diffs, key=diffs.get)
+    print(f'{name:<32}max diff {diffs[worst]:.2e} ({worst})')
+    if diffs[worst] > atol:
+        raise RuntimeError(f'{name} differs from the original by {diffs[worst]} in {worst}')
+
+def check(args):
+    torch.manual_seed(args.seed)
+    torch.set_default_dtype(torch.float64)
+    n, s, c = args.nodes, args.sp, args.classes
+    f = args.in_feats + args.planar_feats
+    plane_edges = torch.randint(n, (2, args.edges))
+    nexus_edges = torch.stack((torch.randint(n, (args.edges,)),
+                               torch.randint(s, (args.edges,))))
+
+    compare('NuGraph2 MessagePassing2D',
+            plane2.MessagePassing2D(args.in_feats, args.planar_feats, c),
+            plane2.DecomposedMessagePassing2D(args.in_feats, args.planar_feats, c),
+            [torch.randn(n, c, f), plane_edges], args.atol)
+    compare('NuGraph2 NexusDown',
+            nexus2.NexusDown(args.planar_feats, args.nexus_feats, c),
+            nexus2.DecomposedNexusDown(args.planar_feats, args.nexus_feats, c),
+            [torch.randn(n, c, args.planar_feats), nexus_edges,
+             torch.randn(s, c, args.nexus_feats)], args.atol)
+    compare('NuGraph3 MessagePassing2D',
+            plane3.MessagePassing2D(args.in_feats, args.planar_feats),
+            plane3.DecomposedMessagePassing2D(args.in_feats, args.planar_feats),
+            [torch.randn(n, f), plane_edges], args.atol)
+    compare('NuGraph3 NexusDown',
+            nexus3.NexusDown(args.planar_feats, args.nexus_feats),
+            nexus3.DecomposedNexusDown(args.planar_feats, args.nexus_feats),
+            [torch.randn(n, args.planar_feats), nexus_edges,
+             torch.randn(s, args.nexus_feats)], args.atol)
+    print('decomposed edge networks match the originals')
+
+if __name__ == '__main__':
+    args = configure()
+    check(args)
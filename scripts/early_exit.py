@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import time
+import argparse
+import torch
+import nugraph as ng
+
+Data = ng.data.H5DataModule
+Model = ng.models.NuGraph3
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file for trained model')
+    parser.add_argument('--tolerances', type=float, nargs='+',
+                        default=[0.1, 0.05, 0.02, 0.01, 0.005],
+                        help='Early exit tolerances to evaluate')
+    parser.add_argument('--per-batch', action='store_true', default=False,
+                        help='Exit per batch rather than per graph')
+    parser.add_argument('--min-iters', type=int, default=1,
+                        help='Minimum number of message-passing iterations')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Max number of test batches to evaluate')
+    parser = Data.add_data_args(parser)
+    return parser.parse_args()
+
+def evaluate(model: Model, nudata: Data, tol: float, args) -> dict[str, float]:
+    '''Measure throughput and accuracy on the test split at a given tolerance'''
+    ngraphs, itime, iters = 0, 0., 0.
+    correct, labelled, filter_correct, nodes = 0, 0, 0, 0
+    with torch.no_grad():
+        for i, batch in enumerate(nudata.test_dataloader()):
+            if i == args.limit:
+                break
+            start = time.time()
+            if tol is None:
+                x = model(batch.collect('x'),
+                          { p: batch[p, 'plane', p].edge_index for p in model.planes },
+                          { p: batch[p, 'nexus', 'sp'].edge_index for p in model.planes },
+                          torch.empty(batch['sp'].num_nodes, 0),
+                          { p: batch[p].batch for p in model.planes })
+                n = torch.full((batch.num_graphs,), model.num_iters)
+            else:
+                x, n = model.forward_early_exit(batch, tol,
+                                                per_graph=not args.per_batch,
+                                                min_iters=args.min_iters)
+            itime += time.time() - start
+            ngraphs += batch.num_graphs
+            iters += n.sum().item()
+            for p in model.planes:
+                y = batch[p].y_semantic
+                if 'x_semantic' in x:
+                    mask = y != -1
+                    pred = x['x_semantic'][p].argmax(dim=1)
+                    correct += (pred[mask] == y[mask]).sum().item()
+                    labelled += mask.sum().item()
+                if 'x_filter' in x:
+                    pred = x['x_filter'][p] > 0.5
+                    filter_correct += (pred == (y != -1)).sum().item()
+                    nodes += y.size(0)
+    return {
+        'throughput [graphs/s]': ngraphs / itime,
+        'mean iterations': iters / ngraphs,
+        'semantic accuracy': correct / labelled if labelled else float('nan'),
+        'filter accuracy': filter_correct / nodes if nodes else float('nan'),
+    }
+
+def early_exit(args):
+
+    print('data path =',args.data_path)
+    nudata = Data(args.data_path, batch_size=args.batch_size)
+
+    print('using checkpoint =',args.checkpoint)
+    model = Model.load_from_checkpoint(args.checkpoint, map_location='cpu')
+    model.freeze()
+
+    results = [ ('full', evaluate(model, nudata, None, args)) ]
+    for tol in args.tolerances:
+        results.append((str(tol), evaluate(model, nudata, tol, args)))
+
+    keys = list(results[0][1].keys())
+    print(f'{"tolerance":<12}' + ''.join(f'{key:>24}' for key in keys))
+    for tol, res in results:
+        print(f'{tol:<12}' + ''.join(f'{res[key]:>24.4f}' for key in keys))
+
+if __name__ == '__main__':
+    args = configure()
+    early_exit(args)
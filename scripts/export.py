@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+import os
+import argparse
+import itertools
+import nugraph as ng
+from nugraph.models.nugraph3 import check_compiled, export_inference
+
+Data = ng.data.H5DataModule
+Models = {
+    'nugraph2': ng.models.NuGraph2,
+    'nugraph3': ng.models.NuGraph3,
+}
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file for trained model')
+    parser.add_argument('--outfile', type=str, required=True,
+                        help='Output file name (full path)')
+    parser.add_argument('--model', type=str, default='nugraph3',
+                        choices=Models.keys(),
+                        help='Model architecture of checkpoint')
+    parser.add_argument('--format', type=str, default='pt2',
+                        choices=['pt2', 'onnx'],
+                        help='Export format')
+    parser.add_argument('--no-check', action='store_true', default=False,
+                        help='Skip numerical parity check against eager mode')
+    parser.add_argument('--compile-check-batches', type=int, default=3,
+                        help='Number of batches to check compiled NuGraph3 inference against eager mode on')
+    parser = Data.add_data_args(parser)
+    return parser.parse_args()
+
+def export(args):
+
+    print('data path =',args.data_path)
+    nudata = Data(args.data_path, batch_size=args.batch_size)
+
+    print('using checkpoint =',args.checkpoint)
+    model = Models[args.model].load_from_checkpoint(args.checkpoint, map_location='cpu')
+    model.freeze()
+
+    print('output file =',args.outfile)
+    if os.path.isfile(args.outfile):
+        raise Exception(f'file {args.outfile} already exists!')
+
+    batch = next(iter(nudata.test_dataloader()))
+    if args.format == 'onnx':
+        ng.models.export_onnx(model, batch, args.outfile, check=not args.no_check)
+    elif args.model == 'nugraph3':
+        export_inference(model, batch, args.outfile, check=not args.no_check)
+        if not args.no_check and args.compile_check_batches:
+            batches = list(itertools.islice(nudata.test_dataloader(), args.compile_check_batches))
+            check_compiled(model, batches)
+            print(f'compiled inference matches eager mode on {len(batches)} batches')
+    else:
+        raise Exception('pt2 export is only supported for NuGraph3')
+
+if __name__ == '__main__':
+    args = configure()
+    export(args)
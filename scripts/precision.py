@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from torch_geometric.loader import DataLoader
+import nugraph as ng
+
+Data = ng.data.H5DataModule
+Model = ng.models.NuGraph3
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file for trained model')
+    parser.add_argument('--num-events', type=int, default=256,
+                        help='Number of largest training events to benchmark on')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of passes over the benchmark events')
+    parser = Data.add_data_args(parser)
+    return parser.parse_args()
+
+def run(model: Model, batches: list, dtype: torch.dtype, train: bool) -> dict[str, float]:
+    '''Time model steps under autocast and measure peak memory growth
+
+    The first batch is run once untimed as warm-up, though its memory
+    counts towards the peak. This is called in a freshly spawned process
+    for each configuration, so no configuration inherits allocator state
+    or warm caches from another.'''
+    model.train(train)
+    ngraphs = sum(batch.num_graphs for batch in batches)
+    def step(batch):
+        with torch.autocast('cpu', dtype=dtype, enabled=dtype!=torch.float32):
+            loss, _ = model.step(batch.clone())
+        if train:
+            loss.backward()
+            model.zero_grad()
+    with ng.util.PeakRSS() as rss, torch.set_grad_enabled(train):
+        step(batches[0])
+        start = time.time()
+        for batch in batches:
+            step(batch)
+        itime = time.time() - start
+    return {
+        'throughput [graphs/s]': ngraphs / itime,
+        'peak memory [GB]': (rss.peak - rss.base) / float(1073741824),
+    }
+
+def precision(args):
+
+    print('data path =',args.data_path)
+    nudata = Data(args.data_path, batch_size=args.batch_size)
+
+    print('using checkpoint =',args.checkpoint)
+    model = Model.load_from_checkpoint(args.checkpoint, map_location='cpu')
+
+    # benchmark on the largest events in the training set
+    idx = np.argsort(nudata.train_datasize)[-args.num_events:]
+    loader = DataLoader(Subset(nudata.train_dataset, idx.tolist()),
+                        batch_size=args.batch_size)
+    batches = list(loader) * args.repeats
+
+    ctx = multiprocessing.get_context('spawn')
+    for stage, train in (('training', True), ('inference', False)):
+        results = {}
+        for dtype in (torch.float32, torch.bfloat16):
+            with ctx.Pool(1) as pool:
+                results[dtype] = pool.apply(run, (model, batches, dtype, train))
+        ref, res = results[torch.float32], results[torch.bfloat16]
+        print(f'{stage}:')
+        print(f'  {"metric":<24}{"float32":>12}{"bf16":>12}{"ratio":>12}')
+        for key in ref:
+            ratio = res[key] / ref[key] if ref[key] else float('nan')
+            print(f'  {key:<24}{ref[key]:>12.4f}{res[key]:>12.4f}{ratio:>12.4f}')
+
+if __name__ == '__main__':
+    args = configure()
+    precision(args)
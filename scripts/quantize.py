@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import time
+import argparse
+import torch
+import nugraph as ng
+from nugraph.models.quantization import quantize_dynamic, quantize_static
+
+Data = ng.data.H5DataModule
+Model = ng.models.NuGraph3
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Checkpoint file for trained model')
+    parser.add_argument('--outfile', type=str, required=True,
+                        help='Output file for quantized model (full path)')
+    parser.add_argument('--mode', type=str, default='dynamic',
+                        choices=['dynamic', 'static'],
+                        help='Quantization mode')
+    parser.add_argument('--calibration-samples', type=int, default=256,
+                        help='Number of validation graphs used for static calibration')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Max number of test batches to evaluate')
+    parser = Data.add_data_args(parser)
+    return parser.parse_args()
+
+def evaluate(model: Model, nudata: Data, limit: int = None) -> dict[str, float]:
+    '''Accumulate test metrics and inference throughput'''
+    ngraphs, itime = 0, 0.
+    with torch.no_grad():
+        for i, batch in enumerate(nudata.test_dataloader()):
+            if i == limit:
+                break
+            start = time.time()
+            model.step(batch, 'test')
+            itime += time.time() - start
+            ngraphs += batch.num_graphs
+    ret = { 'throughput [graphs/s]': ngraphs / itime }
+    for decoder in model.decoders:
+        for key, value in decoder.compute_metrics('test').items():
+            ret[key] = value.item()
+    return ret
+
+def quantize(args):
+
+    print('data path =',args.data_path)
+    nudata = Data(args.data_path, batch_size=args.batch_size)
+
+    print('using checkpoint =',args.checkpoint)
+    model = Model.load_from_checkpoint(args.checkpoint, map_location='cpu')
+    model.freeze()
+
+    print('output file =',args.outfile)
+    if os.path.isfile(args.outfile):
+        raise Exception(f'file {args.outfile} already exists!')
+
+    if args.mode == 'static':
+        qmodel = quantize_static(model, nudata.val_dataset,
+                                 num_samples=args.calibration_samples,
+                                 batch_size=args.batch_size)
+    else:
+        qmodel = quantize_dynamic(model)
+    torch.save(qmodel, args.outfile)
+
+    ref = evaluate(model, nudata, args.limit)
+    res = evaluate(qmodel, nudata, args.limit)
+    print(f'{"metric":<24}{"float32":>12}{"int8":>12}{"delta":>12}')
+    for key in ref:
+        print(f'{key:<24}{ref[key]:>12.4f}{res[key]:>12.4f}{res[key]-ref[key]:>12.4f}')
+    speedup = res['throughput [graphs/s]'] / ref['throughput [graphs/s]']
+    print(f'int8 speedup is {speedup:.2f}x')
+
+if __name__ == '__main__':
+    args = configure()
+    quantize(args)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from torchmetrics.functional import recall
+from nugraph.util import RecallLoss
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--classes', type=int, nargs='+', default=[3, 5, 8, 16],
+                        help='Numbers of classes to benchmark')
+    parser.add_argument('--nodes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000],
+                        help='Numbers of nodes to benchmark')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='Number of timed repeats per configuration')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to benchmark on')
+    parser.add_argument('--atol', type=float, default=1e-5,
+                        help='Maximum absolute difference allowed in loss and gradients')
+    return parser.parse_args()
+
+def reference(input: torch.Tensor, target: torch.Tensor, ignore_index: int = -1) -> torch.Tensor:
+    '''Original torchmetrics-based recall loss'''
+    weight = 1 - recall(input, target, 'multiclass',
+                        num_classes=input.size(1),
+                        average='none',
+                        ignore_index=ignore_index)
+    ce = F.cross_entropy(input, target, reduction='none',
+                         ignore_index=ignore_index)
+    return (weight[target] * ce).mean()
+
+def parity(fused: RecallLoss, input: torch.Tensor, target: torch.Tensor,
+           atol: float, name: str = '') -> float:
+    '''Max absolute difference in loss and input gradient between the fused
+    and reference losses, raising if it exceeds the tolerance'''
+    results = []
+    for fn in (fused, reference):
+        x = input.detach().clone().requires_grad_()
+        loss = fn(x, target)
+        loss.backward()
+        results.append((loss.detach(), x.grad))
+    (loss_f, grad_f), (loss_r, grad_r) = results
+    diff = max((loss_f - loss_r).abs().item(), (grad_f - grad_r).abs().max().item())
+    if not diff <= atol:
+        raise RuntimeError(f'fused recall loss differs from reference by {diff} {name}'.rstrip())
+    return diff
+
+def edge_cases(fused: RecallLoss, device: str, atol: float) -> None:
+    '''Check parity where every target is ignored, and where a class has
+    no support'''
+    input = torch.randn(100, 5, device=device)
+    target = torch.full((100,), -1, device=device)
+    parity(fused, input, target, atol, 'with all targets ignored')
+    target = torch.randint(-1, 4, (100,), device=device)
+    parity(fused, input, target, atol, 'with a class with no support')
+    print('edge cases match reference')
+
+def timeit(fn, input: torch.Tensor, target: torch.Tensor, repeats: int) -> float:
+    '''Mean forward and backward time in milliseconds'''
+    for _ in range(2):
+        fn(input, target).backward()
+    start = time.time()
+    for _ in range(repeats):
+        fn(input, target).backward()
+    if input.is_cuda:
+        torch.cuda.synchronize()
+    return 1000 * (time.time() - start) / repeats
+
+def benchmark(args):
+    fused = RecallLoss()
+    edge_cases(fused, args.device, args.atol)
+    print(f'{"classes":>8}{"nodes":>10}{"reference [ms]":>16}{"fused [ms]":>12}{"speedup":>10}{"max diff":>12}')
+    for c in args.classes:
+        for n in args.nodes:
+            input = torch.randn(n, c, device=args.device, requires_grad=True)
+            target = torch.randint(-1, c, (n,), device=args.device)
+            diff = parity(fused, input, target, args.atol,
+                          f'for {c} classes and {n} nodes')
+            t_ref = timeit(reference, input, target, args.repeats)
+            t_fused = timeit(fused, input, target, args.repeats)
+            print(f'{c:>8}{n:>10}{t_ref:>16.3f}{t_fused:>12.3f}{t_ref/t_fused:>10.2f}{diff:>12.2e}')
+
+if __name__ == '__main__':
+    args = configure()
+    benchmark(args)
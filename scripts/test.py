@@ -2,11 +2,11 @@
 import os
 import time
 import argparse
-import pandas as pd
+import torch
 import pytorch_lightning as pl
+from torch.utils.data import Subset
+from torch_geometric.loader import DataLoader
 import nugraph as ng
-import pynuml
-import tqdm
 
 Data = ng.data.H5DataModule
 Model = ng.models.NuGraph3
@@ -17,41 +17,88 @@ def configure():
                         help='Checkpoint file for trained model')
     parser.add_argument('--outfile', type=str, required=True,
                         help='Output file name (full path)')
+    parser.add_argument('--backend', type=str, default='torch',
+                        choices=['torch', 'onnx'],
+                        help='Inference backend')
+    parser.add_argument('--onnx-model', type=str, default=None,
+                        help='ONNX model file for onnx backend')
+    parser.add_argument('--precision', type=str, default='32',
+                        help='Inference precision, eg. "32" or "bf16-mixed"')
+    parser.add_argument('--early-exit-tol', type=float, default=None,
+                        help='Stop message passing per graph once predictions change less than this')
+    parser.add_argument('--format', type=str, default='hdf5',
+                        choices=['hdf5', 'parquet'],
+                        help='Prediction output file format')
+    parser.add_argument('--compact', type=str, default=None,
+                        choices=['float16', 'uint8'],
+                        help='Compact class scores in parquet output')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resume writing predictions to an existing output file')
     parser = Data.add_data_args(parser)
+    parser = ng.util.ThreadTuner.add_args(parser)
     return parser.parse_args()
 
 def test(args):
 
+    # apply thread settings tuned for this machine, if there are any
+    tuner = ng.util.ThreadTuner.from_args(args)
+    if tuner.apply():
+        print(f'using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads')
+
     print('data path =',args.data_path)
-    nudata = Data(args.data_path, batch_size=args.batch_size)
+    nudata = Data(args.data_path, batch_size=args.batch_size, cache=args.cache)
 
     print('using checkpoint =',args.checkpoint)
     model = Model.load_from_checkpoint(args.checkpoint, map_location='cpu')
+    model.set_early_exit(args.early_exit_tol)
+
+    if args.tune_threads:
+        tuner.tune(model, nudata.test_dataset, args.batch_size)
 
     print('output file =',args.outfile)
-    if os.path.isfile(args.outfile):
+    if args.format == 'parquet':
+        writer = ng.util.ParquetPredictionWriter(args.outfile, nudata.planes,
+                                                 nudata.semantic_classes,
+                                                 compact=args.compact)
+    elif args.compact:
+        raise Exception('the --compact argument requires --format parquet')
+    else:
+        writer = ng.util.PredictionWriter(args.outfile, nudata.planes,
+                                          nudata.semantic_classes)
+    if args.resume:
+        done = writer.resume()
+        print(f'resuming from graph {done}')
+    elif os.path.isfile(args.outfile):
         raise Exception(f'file {args.outfile} already exists!')
+    else:
+        done = 0
+
+    # skip any graphs that were already written
+    dataset = nudata.test_dataset
+    if done:
+        dataset = Subset(dataset, range(done, len(dataset)))
+    loader = DataLoader(dataset, batch_size=args.batch_size)
 
     accelerator, devices = ng.util.configure_device()
     trainer = pl.Trainer(accelerator=accelerator, devices=devices,
-                         logger=False)
-    plot = pynuml.plot.GraphPlot(planes=nudata.planes,
-                                 classes=nudata.semantic_classes)
+                         precision=args.precision, logger=False,
+                         callbacks=[writer])
 
     start = time.time()
-    out = trainer.predict(model, dataloaders=nudata.test_dataloader())
+    if args.backend == 'onnx':
+        if args.onnx_model is None:
+            raise Exception('the --onnx-model argument is required for the onnx backend')
+        session = ng.models.OnnxModel(args.onnx_model, model)
+        for i, batch in enumerate(loader):
+            writer.write(session.predict_step(batch), i)
+        writer.close()
+    else:
+        trainer.predict(model, dataloaders=loader, return_predictions=False)
     end = time.time()
     itime = end - start
-    ngraphs = len(nudata.test_dataset)
+    ngraphs = len(dataset)
     print(f'inference for {ngraphs} events is {itime} s (that\'s {itime/ngraphs} s/graph')
 
-    df = []
-    for ib, batch in enumerate(tqdm.tqdm(out)):
-        for data in batch.to_data_list():
-            df.append(plot.to_dataframe(data))
-    df = pd.concat(df)
-    df.to_hdf(args.outfile, 'hits', format='table')
-
 if __name__ == '__main__':
     args = configure()
     test(args)
\ No newline at end of file
@@ -6,6 +6,7 @@ import torch
 import pytorch_lightning as pl
 from pytorch_lightning.plugins.environments import SLURMEnvironment
 from pytorch_lightning.callbacks import LearningRateMonitor
+from pytorch_lightning.strategies import DDPStrategy
 import nugraph as ng
 import signal
 
@@ -27,17 +28,44 @@ def configure():
                         help='Checkpoint file to resume training from')
     parser.add_argument('--profiler', type=str, default=None,
                         help='Enable requested profiler')
+    parser.add_argument('--module-profile', type=str, default=None,
+                        help='Profile model submodules, and write a Chrome trace to this file')
+    parser.add_argument('--module-profile-steps', type=int, default=100,
+                        help='Number of forward passes to profile submodules for')
+    parser.add_argument('--precision', type=str, default='32',
+                        help='Training precision, eg. "32" or "bf16-mixed"')
+    parser.add_argument('--cpu-processes', type=int, default=None,
+                        help='Train on CPU with this many data-parallel processes, using gloo')
+    parser.add_argument('--cpu-threads', type=int, default=None,
+                        help='Threads per CPU process, by default its share of available cores')
+    parser.add_argument('--telemetry-interval', type=float, default=1.,
+                        help='Seconds between resource usage samples')
+    parser.add_argument('--telemetry-summary', type=float, default=60.,
+                        help='Seconds between logged resource usage summaries')
     parser = Data.add_data_args(parser)
     parser = Model.add_model_args(parser)
+    parser = ng.util.ThreadTuner.add_args(parser)
     return parser.parse_args()
 
 def train(args):
 
     torch.manual_seed(1)
 
+    # pin data-parallel CPU processes to their own cores before any torch
+    # work starts, so that intra-op worker threads inherit the pinning
+    if args.cpu_processes:
+        ng.util.CpuAffinity(args.cpu_processes, args.cpu_threads).pin()
+
+    # apply thread settings tuned for this machine, unless each process is
+    # given its own share of cores for data-parallel CPU training
+    tuner = ng.util.ThreadTuner.from_args(args)
+    if not args.cpu_processes and tuner.apply(stage='train'):
+        print(f'using {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads')
+
     # Load dataset
     nudata = Data(args.data_path, batch_size=args.batch_size, 
-                  shuffle=args.shuffle, balance_frac=args.balance_frac)
+                  shuffle=args.shuffle, balance_frac=args.balance_frac,
+                  cache=args.cache)
 
     if args.name is not None and args.logdir is not None and args.resume is None:
         model = Model.from_args(args, nudata)
@@ -53,12 +81,18 @@ def train(args):
     else:
         raise Exception('You must pass either the --name and --logdir arguments to start an existing training, or the --resume argument to resume an existing one.')
 
+    if args.tune_threads:
+        if args.cpu_processes:
+            raise Exception('thread tuning is not supported for data-parallel CPU training, use --cpu-threads instead')
+        tuner.tune(model, nudata.train_dataset, args.batch_size, train=True)
+
     logger = pl.loggers.TensorBoardLogger(save_dir=logdir,
                                           name=name, version=version,
                                           default_hp_metric=False)
 
     callbacks = [
         LearningRateMonitor(logging_interval='step'),
+        ng.util.Telemetry(args.telemetry_interval, args.telemetry_summary),
     ]
 
     plugins = [
@@ -66,14 +100,45 @@ def train(args):
     ]
 
     accelerator, devices = ng.util.configure_device()
+    strategy = 'auto'
+    if args.cpu_processes:
+        accelerator, devices = 'cpu', args.cpu_processes
+        if args.cpu_processes > 1:
+            strategy = DDPStrategy(process_group_backend='gloo')
+
+    if args.memory_budget and 'NUGRAPH_BATCH_SIZE' in os.environ:
+        # processes launched for data-parallel training reuse the batch size
+        # selected by the launching process, so every rank steps together
+        nudata.batch_size = int(os.environ['NUGRAPH_BATCH_SIZE'])
+    elif args.memory_budget:
+        device = 'cpu'
+        if accelerator != 'cpu' and torch.cuda.is_available():
+            device = f'cuda:{devices[0]}' if isinstance(devices, list) else 'cuda'
+        batch_size = nudata.auto_batch_size(model.to(device), args.memory_budget)
+        model.cpu()
+        os.environ['NUGRAPH_BATCH_SIZE'] = str(batch_size)
+        print(f'selected batch size {batch_size} for a {args.memory_budget} GB memory budget')
+
+    # the data module shards its own samplers across processes
     trainer = pl.Trainer(accelerator=accelerator, devices=devices,
+                         strategy=strategy, use_distributed_sampler=False,
                          max_epochs=args.epochs,
+                         precision=args.precision,
                          limit_train_batches=args.limit_train_batches,
                          limit_val_batches=args.limit_val_batches,
                          logger=logger, profiler=args.profiler,
                          callbacks=callbacks, plugins=plugins)
 
+    if args.module_profile:
+        profiler = ng.util.ModuleProfiler(max_steps=args.module_profile_steps)
+        model.set_profiler(profiler)
+
     trainer.fit(model, datamodule=nudata, ckpt_path=args.resume)
+
+    if args.module_profile:
+        model.set_profiler(None)
+        profiler.log(logger.experiment, trainer.global_step)
+        profiler.export_chrome_trace(args.module_profile)
     trainer.test(datamodule=nudata)
 
 if __name__ == '__main__':
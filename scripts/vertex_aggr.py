@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import time
+import argparse
+import torch
+from nugraph.models.nugraph3.decoders import (SemanticDecoder, FilterDecoder, EventDecoder,
+                                              VertexDecoder, InstanceDecoder)
+
+def configure():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aggr', type=str, nargs='+', default=['lstm', 'attention'],
+                        help='Vertex aggregation functions to benchmark')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 16, 64],
+                        help='Numbers of graphs per batch to benchmark')
+    parser.add_argument('--nodes', type=int, default=1000,
+                        help='Mean number of nodes per plane in each graph')
+    parser.add_argument('--node-feats', type=int, default=128,
+                        help='Number of node features')
+    parser.add_argument('--classes', type=int, default=5,
+                        help='Number of semantic and event classes')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='Number of timed repeats per configuration')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='Device to benchmark on')
+    return parser.parse_args()
+
+def timeit(fn, repeats: int, cuda: bool) -> float:
+    '''Mean call time in milliseconds'''
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return 1000 * (time.time() - start) / repeats
+
+def benchmark(args):
+    '''Forward latency of the vertex head, with each aggregation function,
+    against every other decoder head on the same inputs'''
+    planes = ['u', 'v', 'y']
+    classes = [ f'class{i}' for i in range(args.classes) ]
+    f = args.node_feats
+    heads = {
+        'semantic': SemanticDecoder(f, planes, classes),
+        'filter': FilterDecoder(f, planes),
+        'event': EventDecoder(f, planes, classes),
+        'instance': InstanceDecoder(f, planes),
+    }
+    for aggr in args.aggr:
+        heads[f'vertex-{aggr}'] = VertexDecoder(f, aggr, 32, [32], planes, classes)
+    cuda = torch.device(args.device).type == 'cuda'
+    print(f'{"head":>16}' + ''.join(f'{f"{b} graphs [ms]":>18}' for b in args.batch_size))
+    times = { name: [] for name in heads }
+    for b in args.batch_size:
+        counts = torch.poisson(torch.full((b,), float(args.nodes))).long().clamp(min=1)
+        batch = { p: torch.arange(b).repeat_interleave(counts).to(args.device) for p in planes }
+        x = { p: torch.randn(batch[p].size(0), f, device=args.device) for p in planes }
+        for name, head in heads.items():
+            head = head.to(args.device).eval()
+            with torch.no_grad():
+                times[name].append(timeit(lambda: head(x, batch), args.repeats, cuda))
+    for name, t in times.items():
+        print(f'{name:>16}' + ''.join(f'{ms:>18.3f}' for ms in t))
+
+if __name__ == '__main__':
+    args = configure()
+    benchmark(args)